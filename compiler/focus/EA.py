@@ -7,10 +7,11 @@ import numpy as np
 from time import time, strftime
 from tqdm import tqdm
 from compiler import global_control as gc
+from compiler.focus.batch_evaluator import BatchEvaluator
 
 class EvolutionController:
     def __init__(self, mutate_prob=0.1, population_size=100, n_evolution=50, parent_fraction=0.5,\
-         mutation_fraction=0.25, crossover_fraction=0.25, log_path='buffer'):
+         mutation_fraction=0.25, crossover_fraction=0.25, log_path='buffer', crossover_operators=None):
         # evolution hyper-parameters
         # self.n_blocks_mutate_prob = kwargs.get('n_blocks_mutate_prob', 0.1)
         # self.n_base_channels_mutate_prob = kwargs.get('n_base_channels_mutate_prob', 0.5)
@@ -23,6 +24,9 @@ class EvolutionController:
         self.parent_num = int(self.population_size*parent_fraction)
         self.mutation_num = int(self.population_size*mutation_fraction)
         self.crossover_num = int(self.population_size*crossover_fraction)
+        # Every child picks one of these operators, we count how often it beats both of its parents
+        self.crossover_operators = list(gc.crossover_operators if crossover_operators is None else crossover_operators)
+        self.crossover_stats = {op: [0, 0] for op in self.crossover_operators}
         self.log_path = log_path
         if not os.path.exists(self.log_path):
             os.makedirs(self.log_path)
@@ -70,10 +74,26 @@ class EvolutionController:
     
     def crossover(self,parents):
         for _ in range(self.crossover_num):
-            selected_parent1=parents[np.random.randint(self.parent_num)]
-            selected_parent2=parents[np.random.randint(self.parent_num)]
-            child=selected_parent1.crossover(selected_parent1,selected_parent2)
+            idx1, idx2 = np.random.randint(self.parent_num), np.random.randint(self.parent_num)
+            selected_parent1=parents[idx1]
+            selected_parent2=parents[idx2]
+            operator = self.crossover_operators[np.random.randint(len(self.crossover_operators))]
+            child=selected_parent1.crossover(selected_parent1,selected_parent2,operator)
             self.add_individual(child)
+            self.record_crossover(operator, self.scores[-1], self.scores[idx1], self.scores[idx2])
+
+    def record_crossover(self, operator, child_score, parent1_score, parent2_score):
+        stat = self.crossover_stats[operator]
+        stat[0] += 1
+        if child_score > max(parent1_score, parent2_score):
+            stat[1] += 1
+
+    def report_crossover(self):
+        lines = []
+        for op, (n_children, n_improved) in self.crossover_stats.items():
+            rate = n_improved / n_children if n_children else 0
+            lines.append(f"crossover {op}: {n_improved}/{n_children} offspring improved, rate {rate:.3f}")
+        return "\n".join(lines)
 
     def run_evolution_search(self, verbose=False):
 
@@ -102,6 +122,7 @@ class EvolutionController:
             for i in sorted_inds[:3]:
                 # self.log_file.write(f"{self.scores[i]} {self.population[i]}\n")
                 self.log_file.write(f"{self.scores[i]}\n")
+            self.log_file.write(self.report_crossover() + "\n")
             self.log_file.flush()
             
             best_score_history.append(now_best_score)
@@ -117,8 +138,10 @@ class EvolutionController:
             self.crossover(parents)
 
         print('Finish Evolution Search')
+        print(self.report_crossover())
         ind = np.argmax(self.scores)
         end_time = time()
+        self.log_file.write(self.report_crossover() + "\n")
         self.log_file.write("Evolution search time: {}".format(end_time - start_time))
         self.log_file.flush()
         return self.population[ind], self.scores[ind]
@@ -142,19 +165,19 @@ def individual_mutation_process(pid, parent):
         score = child.evaluate()
     return child,score
 
-def individual_crossover_process(pid,parents):
+def individual_crossover_process(pid,parents,operator):
     # print(f"start {pid}")
     with open(os.path.join(gc.get_ea_logpath(), "individual.out"), "a+") as outf:
         if not gc.scheduler_verbose:
             sys.stdout = outf
-        child = parents[0].crossover(*parents)
+        child = parents[0].crossover(*parents, operator)
         score = child.evaluate()
     return child,score
 
 
 class ParallelEvolutionController(EvolutionController):
-    def __init__(self, n_workers=8, mutate_prob=0.1, population_size=100, n_evolution=50, parent_fraction=0.5, mutation_fraction=0.25, crossover_fraction=0.25, log_path='buffer'):
-        super().__init__(mutate_prob=mutate_prob, population_size=population_size, n_evolution=n_evolution, parent_fraction=parent_fraction, mutation_fraction=mutation_fraction, crossover_fraction=crossover_fraction, log_path=log_path)
+    def __init__(self, n_workers=8, mutate_prob=0.1, population_size=100, n_evolution=50, parent_fraction=0.5, mutation_fraction=0.25, crossover_fraction=0.25, log_path='buffer', crossover_operators=None):
+        super().__init__(mutate_prob=mutate_prob, population_size=population_size, n_evolution=n_evolution, parent_fraction=parent_fraction, mutation_fraction=mutation_fraction, crossover_fraction=crossover_fraction, log_path=log_path, crossover_operators=crossover_operators)
         self.n_workers=n_workers
 
     def init_population(self, individual_generator,allow_repeat=False,max_sample_times=1000):
@@ -188,12 +211,55 @@ class ParallelEvolutionController(EvolutionController):
     def crossover(self, parents):
         pool = mp.Pool(processes=self.n_workers)
         selected_parents=[]
+        selected_idx=[]
+        operators=[]
         for _ in range(self.mutation_num):
-            selected_parent1=parents[np.random.randint(self.parent_num)]
-            selected_parent2=parents[np.random.randint(self.parent_num)]
+            idx1, idx2 = np.random.randint(self.parent_num), np.random.randint(self.parent_num)
+            selected_parent1=parents[idx1]
+            selected_parent2=parents[idx2]
             selected_parents.append([selected_parent1,selected_parent2])
+            selected_idx.append((idx1, idx2))
+            operators.append(self.crossover_operators[np.random.randint(len(self.crossover_operators))])
         
-        rst = pool.starmap(individual_crossover_process,[ (pid,parent) for pid,parent in enumerate(selected_parents)])
-        for i,s in rst:
+        rst = pool.starmap(individual_crossover_process,[ (pid,parent,op) for pid,(parent,op) in enumerate(zip(selected_parents,operators))])
+        for (i,s),(idx1,idx2),op in zip(rst,selected_idx,operators):
+            self.add_individual(i,s)
+            self.record_crossover(op, s, self.scores[idx1], self.scores[idx2])
+        pool.close()
+
+class BatchEvolutionController(EvolutionController):
+    '''Breed a whole generation first, then score all new individuals at once with a `BatchEvaluator`.
+    '''
+    def __init__(self, mutate_prob=0.1, population_size=100, n_evolution=50, parent_fraction=0.5, mutation_fraction=0.25, crossover_fraction=0.25, log_path='buffer', crossover_operators=None):
+        super().__init__(mutate_prob=mutate_prob, population_size=population_size, n_evolution=n_evolution, parent_fraction=parent_fraction, mutation_fraction=mutation_fraction, crossover_fraction=crossover_fraction, log_path=log_path, crossover_operators=crossover_operators)
+        self.evaluator = None
+
+    def evaluate_all(self, individuals):
+        if self.evaluator is None:
+            self.evaluator = BatchEvaluator(individuals[0].array_shape)
+        return self.evaluator.evaluate(individuals)
+
+    def init_population(self, individual_generator,allow_repeat=False,max_sample_times=1000):
+        self.population.clear()
+        print(f"Generate {self.population_size} individuals Batched")
+        individuals = [individual_generator() for _ in range(self.population_size)]
+        for i,s in zip(individuals, self.evaluate_all(individuals)):
+            self.add_individual(i,s)
+
+    def mutation(self, parents):
+        children = [parents[np.random.randint(self.parent_num)].mutate() for _ in range(self.mutation_num)]
+        for i,s in zip(children, self.evaluate_all(children)):
+            self.add_individual(i,s)
+
+    def crossover(self, parents):
+        children, selected_idx, operators = [], [], []
+        for _ in range(self.crossover_num):
+            idx1, idx2 = np.random.randint(self.parent_num), np.random.randint(self.parent_num)
+            operator = self.crossover_operators[np.random.randint(len(self.crossover_operators))]
+            children.append(parents[idx1].crossover(parents[idx1], parents[idx2], operator))
+            selected_idx.append((idx1, idx2))
+            operators.append(operator)
+
+        for i,s,(idx1,idx2),op in zip(children, self.evaluate_all(children), selected_idx, operators):
             self.add_individual(i,s)
-        pool.close()
\ No newline at end of file
+            self.record_crossover(op, s, self.scores[idx1], self.scores[idx2])
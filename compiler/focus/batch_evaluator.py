@@ -0,0 +1,249 @@
+import numpy as np
+from math import ceil
+from time import time
+
+from compiler import global_control as gc
+from compiler.focus import individual as focus_individual
+from compiler.focus.individual import XYRouter, YXRouter, routing_algorithms
+
+
+class BatchEvaluator():
+    r'''Evaluate a whole population at once. \
+    Individuals of one search share the packet table and only differ in their routing genes \
+    (intermediate nodes and per-segment routing algorithms), so paths are built for all of them together \
+    and the injection harmonizer runs in lockstep along a population axis. \
+    Scores equal `Individual.evaluate`, both break the ties between equally-ready packets in the order \
+    of the temporal mapping.
+    '''
+
+    n_ports = 6
+
+    def __init__(self, array_shape):
+        self.array_shape = array_shape
+        self.array_size = array_shape[0] * array_shape[1]
+        self.n_channels = self.array_size * self.n_ports
+        self.routers = [algorithm(array_shape) for algorithm in routing_algorithms]
+        # (algorithm, src, dst) -> channel ids, for the algorithms that are not vectorized
+        self.segment_cache = {}
+
+    def evaluate(self, individuals: list) -> list:
+        start_time = time()
+
+        # Mixing routing algorithms may close a cycle of turns, see `Individual.repairRouting`
+        if gc.deadlock_check:
+            for ind in individuals:
+                ind.repairRouting(self.routers)
+
+        packets = self._gen_packet_table(individuals[0].getTrace())
+        channels, entry_seg, seg_pop, seg_pkt, seg_len = self._gen_segments(individuals, packets)
+
+        paths, path_len = self._gen_paths(len(individuals), packets, channels, entry_seg, seg_pop, seg_pkt, seg_len)
+        self.port_load = self._gen_port_load(packets, paths)
+
+        issue_time, delay = self._harmonize(packets, paths, path_len)
+
+        # These scores are adopted when ping-pong buffer is assumed, see `Individual.evaluate`
+        scores = self._score(packets, delay)
+
+        issue_time *= packets["counts"] / packets["count"]
+        for ind, score, it, dl in zip(individuals, scores, issue_time, delay):
+            trace = ind.getTrace()
+            trace.loc[packets["index"], "issue_time"] = it
+            trace.loc[packets["index"], "delay"] = dl
+            trace.loc[packets["index"], "is_bound"] = dl > 0
+
+            if score > focus_individual.best_solution[1]:
+                focus_individual.best_solution = (trace.copy(), score)
+
+        end_time = time()
+        print("Batch evaluate time: {} Population: {} Best score: {}".format(end_time - start_time, len(individuals), scores.max()))
+        return list(scores)
+
+    def _gen_packet_table(self, trace):
+        # Temporal map, see `FocusTemporalMapper`
+        order = np.argsort(trace["interval"].to_numpy(), kind="stable")
+        trace = trace.iloc[order]
+
+        counts = trace["counts"].to_numpy().astype(float)
+        return {
+            "order": order,
+            "index": trace.index.to_numpy(),
+            "flit": trace["flit"].to_numpy().astype(float),
+            "interval": trace["interval"].to_numpy().astype(float),
+            "counts": counts,
+            # accelerate harmonizer
+            "count": np.array([ceil(c * gc.shrink) for c in counts]),
+            "layer": trace["layer"].to_numpy(),
+            "captain": ~trace["captain"].isna().to_numpy(),
+            "tree": [np.array([r * self.n_ports + p for r, p in tree], dtype=np.int64) for tree in trace["tree"]],
+        }
+
+    def _gen_segments(self, individuals, packets):
+        r'''Route every segment between milestones for the whole population. \
+            Return the channel ids (router * 6 + output port) of all segment entries, the segment of each entry, \
+            and the individual, packet and hop count of each segment.
+        '''
+        seg_pop, seg_pkt, seg_src, seg_dst, seg_algo = [], [], [], [], []
+        for p, ind in enumerate(individuals):
+            trace = ind.getTrace().iloc[packets["order"]]
+            for n, (src, inter, dst, captain, genes) in enumerate(zip(trace["src"], trace["intermediate"], trace["dst"],
+                                                                        trace["captain"], trace["routing"])):
+                ends = dst if not packets["captain"][n] else [int(captain)]
+                milestones = src + inter + ends
+                seg_pop += [p] * (len(milestones) - 1)
+                seg_pkt += [n] * (len(milestones) - 1)
+                seg_src += milestones[:-1]
+                seg_dst += milestones[1:]
+                seg_algo += genes[:len(milestones) - 1]
+
+        seg_pop, seg_pkt = np.array(seg_pop), np.array(seg_pkt)
+        seg_src, seg_dst, seg_algo = np.array(seg_src), np.array(seg_dst), np.array(seg_algo)
+
+        isize, jsize = self.array_shape
+        isrc, jsrc = seg_src // isize, seg_src % isize
+        idst, jdst = seg_dst // isize, seg_dst % isize
+        di, dj = np.abs(idst - isrc), np.abs(jdst - jsrc)
+        si, sj = np.where(idst > isrc, 1, -1), np.where(jdst > jsrc, 1, -1)
+        seg_len = di + dj
+
+        # One entry per visited router, the last one is the output port of the segment's destination
+        seg_start = np.concatenate(([0], np.cumsum(seg_len + 1)[:-1]))
+        entry_seg = np.repeat(np.arange(seg_len.size), seg_len + 1)
+        k = np.arange(entry_seg.size) - seg_start[entry_seg]
+
+        ports = XYRouter.port_number
+        i_port = np.where(si > 0, ports["south"], ports["north"])[entry_seg]
+        j_port = np.where(sj > 0, ports["east"], ports["west"])[entry_seg]
+        ei, ej, edi, edj = isrc[entry_seg], jsrc[entry_seg], di[entry_seg], dj[entry_seg]
+        esi, esj = si[entry_seg], sj[entry_seg]
+        last = k == seg_len[entry_seg]
+
+        channels = np.full(entry_seg.size, -1, dtype=np.int64)
+
+        # x-routing first, then y-routing
+        sel = seg_algo[entry_seg] == routing_algorithms.index(XYRouter)
+        first = sel & (k < edj)
+        channels[first] = (ei * jsize + ej + k * esj)[first] * self.n_ports + j_port[first]
+        second = sel & (k >= edj) & ~last
+        channels[second] = ((ei + (k - edj) * esi) * jsize + jdst[entry_seg])[second] * self.n_ports + i_port[second]
+
+        # y-routing first, then x-routing
+        sel = seg_algo[entry_seg] == routing_algorithms.index(YXRouter)
+        first = sel & (k < edi)
+        channels[first] = ((ei + k * esi) * jsize + ej)[first] * self.n_ports + i_port[first]
+        second = sel & (k >= edi) & ~last
+        channels[second] = (idst[entry_seg] * jsize + ej + (k - edi) * esj)[second] * self.n_ports + j_port[second]
+
+        channels[last] = seg_dst[entry_seg[last]] * self.n_ports + ports["output"]
+
+        # The other routing algorithms are not vectorized, route their distinct segments one by one
+        for seg in np.flatnonzero((seg_algo != routing_algorithms.index(XYRouter)) & (seg_algo != routing_algorithms.index(YXRouter))):
+            key = (seg_algo[seg], seg_src[seg], seg_dst[seg])
+            if key not in self.segment_cache:
+                path = self.routers[seg_algo[seg]].getPath(int(seg_src[seg]), int(seg_dst[seg]))
+                self.segment_cache[key] = np.array([r * self.n_ports + p for r, p in path], dtype=np.int64)
+            channels[seg_start[seg]: seg_start[seg] + seg_len[seg] + 1] = self.segment_cache[key]
+
+        return channels, entry_seg, seg_pop, seg_pkt, seg_len
+
+    def _gen_paths(self, n_pop, packets, channels, entry_seg, seg_pop, seg_pkt, seg_len):
+        r'''Concatenate segments (without the output port of every milestone) and multicast trees into \
+            a padded (population, packet, hop) array of channel ids, -1 for padding.
+        '''
+        n_pkts = len(packets["index"])
+
+        seg_end = np.cumsum(seg_len + 1) - 1
+        keep = np.ones(channels.size, dtype=bool)
+        keep[seg_end] = False
+        owner = (seg_pop * n_pkts + seg_pkt)[entry_seg[keep]]
+        hops = channels[keep]
+
+        # Append the branching tree to the packets with captains
+        tree_owner = [p * n_pkts + n for p in range(n_pop) for n in np.flatnonzero(packets["captain"])]
+        tree_hops = [packets["tree"][o % n_pkts] for o in tree_owner]
+        tree_owner = np.repeat(np.array(tree_owner, dtype=np.int64), [t.size for t in tree_hops])
+        tree_hops = np.concatenate(tree_hops) if tree_hops else np.zeros(0, dtype=np.int64)
+
+        owner = np.concatenate((owner, tree_owner))
+        hops = np.concatenate((hops, tree_hops))
+        order = np.argsort(owner, kind="stable")
+        owner, hops = owner[order], hops[order]
+
+        path_len = np.bincount(owner, minlength=n_pop * n_pkts)
+        start = np.concatenate(([0], np.cumsum(path_len)[:-1]))
+        position = np.arange(owner.size) - start[owner]
+
+        paths = np.full((n_pop * n_pkts, max(path_len.max(), 1)), -1, dtype=np.int64)
+        paths[owner, position] = hops
+        return paths.reshape(n_pop, n_pkts, -1), path_len.reshape(n_pop, n_pkts)
+
+    def _gen_port_load(self, packets, paths):
+        # Flits per cycle injected to every output port, for each individual
+        n_pop = paths.shape[0]
+        intensity = np.broadcast_to((packets["flit"] / packets["interval"])[None, :, None], paths.shape)
+        valid = paths >= 0
+        flat = (np.arange(n_pop)[:, None, None] * self.n_channels + paths)[valid]
+        load = np.bincount(flat, weights=intensity[valid], minlength=n_pop * self.n_channels)
+        return load.reshape(n_pop, self.n_channels)
+
+    def _harmonize(self, packets, paths, path_len):
+        r'''`InjectionHarmonizer.run` for all individuals in lockstep: at each step every unfinished \
+            individual issues (or delays) its first-ready packet.
+        '''
+        n_pop, n_pkts, max_len = paths.shape
+        flit, interval, count = packets["flit"], packets["interval"], packets["count"]
+
+        issue_time = np.zeros((n_pop, n_pkts))
+        delay = np.zeros((n_pop, n_pkts))
+        remain = np.tile(count, (n_pop, 1))
+        unsolved = np.ones((n_pop, n_pkts), dtype=bool)
+        grab_end = np.zeros((n_pop, self.n_channels))
+        hop_offset = np.arange(max_len) + 1
+
+        iter_cnt = 0
+        while unsolved.any():
+            iter_cnt += 1
+            if gc.scheduler_verbose and iter_cnt % 500 == 0:
+                print("iteration: {}, remained packets: {}".format(iter_cnt, unsolved.sum()))
+
+            active = np.flatnonzero(unsolved.any(axis=1))
+            # Greedy strategy: issue the first-ready packet
+            pkt = np.argmin(np.where(unsolved[active], issue_time[active], np.inf), axis=1)
+
+            path = paths[active, pkt]
+            valid = path >= 0
+            grab_time = flit[pkt][:, None] + hop_offset[None, :]
+            now = issue_time[active, pkt]
+
+            wait_until = np.where(valid, grab_end[active[:, None], np.where(valid, path, 0)], -np.inf).max(axis=1)
+            issue = now >= wait_until
+
+            # issue the packet: routers out of the path are released at once
+            rows = active[issue]
+            grab_end[rows] = now[issue][:, None]
+            vr, vc = np.nonzero(valid[issue])
+            grab_end[rows[vr], path[issue][vr, vc]] = now[issue][vr] + grab_time[issue][vr, vc]
+
+            ipkt = pkt[issue]
+            left = remain[rows, ipkt]
+            remain[rows, ipkt] = left - 1
+            finished = left <= 0
+            unsolved[rows[finished], ipkt[finished]] = False
+
+            cont, cpkt = rows[~finished], ipkt[~finished]
+            grab_max = flit[cpkt] + path_len[cont, cpkt]
+            delay[cont, cpkt] += grab_max + issue_time[cont, cpkt] - (count[cpkt] - remain[cont, cpkt]) * interval[cpkt]
+            delay[cont, cpkt] = np.maximum(0, delay[cont, cpkt])
+            issue_time[cont, cpkt] += interval[cpkt]
+
+            # delay the packet
+            issue_time[active[~issue], pkt[~issue]] = wait_until[~issue]
+
+        delay /= count
+        print("Iteration counts: {}".format(iter_cnt))
+        return issue_time, delay
+
+    def _score(self, packets, delay):
+        finish = (delay + packets["interval"]) * packets["counts"]
+        layer_finish = np.stack([finish[:, packets["layer"] == layer].max(axis=1) for layer in np.unique(packets["layer"])], axis=1)
+        return -np.quantile(layer_finish, gc.quantile_, axis=1)
@@ -3,12 +3,14 @@ import re
 import os
 import numpy as np
 import pandas as pd
+import networkx as nx
 from copy import deepcopy
 import random
 from math import ceil
 from time import time
 
 from compiler import global_control as gc
+from compiler.focus import trace_store
 
 INF = 1e10
 
@@ -20,39 +22,47 @@ class XYRouter:
     def __init__(self, shape:tuple):
         self.shape = shape
         assert(len(shape) == 2)
-    
+
     def getPath(self, src, dst):
         '''
             Return:
                 Path from `src` to `dst`, in the format of a list of (router, output port)
         '''
-        isize, jsize = self.shape
-        
-        def getCoordinates(index):
-            return index // isize, index % isize
-        
-        def getIndex(i, j):
-            return i * jsize + j
+        router_path = self._getRouterPath(src, dst)
+
+        # get ports
+        router_path += [dst] * 2   # append the last router to calculate the output port of last router
+        oport_path = [self._getOutPort(router_path[i], router_path[i + 1]) for i in range(len(router_path) - 1)]
 
-        isrc, jsrc = getCoordinates(src)
-        idst, jdst = getCoordinates(dst)
+        return list(zip(router_path, oport_path))
+
+    def _getRouterPath(self, src, dst):
+        '''
+            Return:
+                Routers visited from `src` to `dst`, excluding `dst` itself
+        '''
+        isrc, jsrc = self._getCoordinates(src)
+        idst, jdst = self._getCoordinates(dst)
 
         istep = 1 if isrc < idst else -1
         jstep = 1 if jsrc < jdst else -1
 
         router_path = []
         # x-routing, keep i
-        router_path += [getIndex(isrc, j) for j in range(jsrc, jdst, jstep)]
+        router_path += [self._getIndex(isrc, j) for j in range(jsrc, jdst, jstep)]
         # y-routing, keep j
-        router_path += [getIndex(i, jdst) for i in range(isrc, idst, istep)]
+        router_path += [self._getIndex(i, jdst) for i in range(isrc, idst, istep)]
+        return router_path
 
-        # get ports
-        router_path += [getIndex(idst, jdst)] * 2   # append the last router to calculate the output port of last router
-        oport_path = [self.__getOutPort(router_path[i], router_path[i + 1]) for i in range(len(router_path) - 1)]
+    def _getCoordinates(self, index):
+        isize, _ = self.shape
+        return index // isize, index % isize
 
-        return list(zip(router_path, oport_path))
+    def _getIndex(self, i, j):
+        _, jsize = self.shape
+        return i * jsize + j
 
-    def __getOutPort(self, from_, to_):
+    def _getOutPort(self, from_, to_):
         bias = to_ - from_
         
         # east
@@ -70,6 +80,96 @@ class XYRouter:
             raise Exception("The two nodes are not neighbours!")
 
 
+class YXRouter(XYRouter):
+
+    def _getRouterPath(self, src, dst):
+        isrc, jsrc = self._getCoordinates(src)
+        idst, jdst = self._getCoordinates(dst)
+
+        istep = 1 if isrc < idst else -1
+        jstep = 1 if jsrc < jdst else -1
+
+        router_path = []
+        # y-routing, keep j
+        router_path += [self._getIndex(i, jsrc) for i in range(isrc, idst, istep)]
+        # x-routing, keep i
+        router_path += [self._getIndex(idst, j) for j in range(jsrc, jdst, jstep)]
+        return router_path
+
+
+class OddEvenRouter(XYRouter):
+    '''Minimal odd-even turn model (Chiu, 2000): east-to-north/south turns are forbidden in even columns 
+        and north/south-to-west turns are forbidden in odd columns. Among the admissible directions we 
+        move along the dimension with the larger remaining offset, so the path is deterministic. 
+    '''
+
+    def _getRouterPath(self, src, dst):
+        isrc, jsrc = self._getCoordinates(src)
+        idst, jdst = self._getCoordinates(dst)
+
+        router_path = []
+        i, j = isrc, jsrc
+        while (i, j) != (idst, jdst):
+            router_path.append(self._getIndex(i, j))
+            di, dj = idst - i, jdst - j
+            istep = 1 if di > 0 else -1
+            jstep = 1 if dj > 0 else -1
+
+            avail = []
+            if dj == 0:
+                avail.append("y")
+            elif dj > 0:
+                if di == 0:
+                    avail.append("x")
+                else:
+                    if j % 2 == 1 or j == jsrc:
+                        avail.append("y")
+                    if jdst % 2 == 1 or dj != 1:
+                        avail.append("x")
+            else:
+                avail.append("x")
+                if di != 0 and j % 2 == 0:
+                    avail.append("y")
+
+            if "x" in avail and ("y" not in avail or abs(dj) >= abs(di)):
+                j += jstep
+            else:
+                i += istep
+        return router_path
+
+
+# The routing algorithms selectable by the per-segment routing genes
+routing_algorithms = [XYRouter, YXRouter, OddEvenRouter]
+
+
+def closes_cycle(cdg, chain):
+    '''Check whether appending the channels of `chain`, one after another, to the dependency graph `cdg`
+        closes a cycle through them. Cycles among the channels of `cdg` alone are not reported.
+        Input: 
+            a channel dependency graph and a list of (router, output port)
+        Return: 
+            True if a cycle goes through an edge of the chain
+    '''
+    if len(set(chain)) < len(chain):
+        return True
+    # A cycle through the chain needs a path of `cdg` back from a channel to an earlier one of the chain;
+    # searching from the last channel first, nodes seen from a later channel need no second visit
+    position = {channel: i for i, channel in enumerate(chain)}
+    visited = set()
+    for j in reversed(range(len(chain))):
+        if chain[j] not in cdg:
+            continue
+        stack = [chain[j]]
+        while stack:
+            for succ in cdg.successors(stack.pop()):
+                if position.get(succ, j) < j:
+                    return True
+                if succ not in visited:
+                    visited.add(succ)
+                    stack.append(succ)
+    return False
+
+
 class InjectionHarmonizer():
 
     packets = pd.DataFrame(columns=["id", "src", "dst", "flit", "interval", "path", "issue_time", "count"])
@@ -103,8 +203,8 @@ class InjectionHarmonizer():
                 if iter_cnt % 500 == 0:
                     print("iteration: {}, remained packets: {}".format(iter_cnt, (working_pkts["unsolved"].value_counts())[True]))
 
-            # Greedy strategy: issue the first-ready packet
-            issued_pkt = working_pkts[working_pkts["unsolved"]].sort_values("issue_time").iloc[0]
+            # Greedy strategy: issue the first-ready packet, ties in the order of the temporal mapping
+            issued_pkt = working_pkts[working_pkts["unsolved"]].sort_values("issue_time", kind="stable").iloc[0]
 
             path = issued_pkt["path"]
             path_ids = list(map(lambda x: x[0] * 6 + x[1], path))
@@ -153,7 +253,7 @@ class InjectionHarmonizer():
 
 def individual_generator():
     focus_trace = os.path.join(gc.focus_buffer, gc.taskname, "trace_{}.json".format(gc.flit_size))
-    p = Individual(pd.read_json(focus_trace), (gc.array_diameter, gc.array_diameter),)
+    p = Individual(trace_store.load_trace(focus_trace), (gc.array_diameter, gc.array_diameter),)
     for _ in range(np.random.randint(100)):
         p.mutate(inplace=True)
     return p
@@ -167,7 +267,7 @@ class FocusTemporalMapper():
 
     def temporal_map(self, packets):
         # ret = packets.sort_values("flit")
-        ret = packets.sort_values("interval")
+        ret = packets.sort_values("interval", kind="stable")
         # delay = ret["delay"].map(lambda x: 0 if pd.isna(x) else x)
         # ret["issue_time"] = delay
         ret["issue_time"] = 0
@@ -180,6 +280,8 @@ class Individual():
         
         trace["intermediate"] = [[] for _ in range(trace.shape[0])] 
         trace["path"] = [[] for _ in range(trace.shape[0])]
+        # One routing gene per segment between milestones, indexing `routing_algorithms`
+        trace["routing"] = [[0] for _ in range(trace.shape[0])]
 
         # For reducing the time of simulating
         # FIXME: Only account for ping-pong buffer
@@ -212,8 +314,11 @@ class Individual():
             new=self
         else:
             new=deepcopy(self)
+            new.copyGenes()
         for _ in range(np.random.randint(50)):
-            if random.random() > 0.6:
+            if gc.routing_genes and random.random() < gc.routing_mutate_prob:
+                new.mutateRouting()
+            elif random.random() > 0.6:
                 new.addImNode()
             else:
                 new.rmImNode()
@@ -223,17 +328,61 @@ class Individual():
         return new
 
     @staticmethod
-    def crossover(left, right):
+    def crossover(left, right, operator="uniform"):
+        '''Copy a block of packet rows from `left` into a copy of `right`. 
+            `operator` names the block structure, see `crossover_operators`.
+        '''
         ltrace, rtrace = left.getTrace(), right.getTrace()
-        left_sel_idx = random.sample(range(ltrace.shape[0]), int(ltrace.shape[0]/2))
+        left_sel_idx = Individual.crossover_operators[operator](left)
 
         child = deepcopy(right)
         ctrace = child.getTrace()
-        ctrace.iloc[left_sel_idx] = ltrace.iloc[left_sel_idx]
+        # Both traces share the row labels, rows assigned by position would be aligned by label
+        rows = ctrace.index[left_sel_idx]
+        ctrace.loc[rows] = ltrace.loc[rows]
         child.setTrace(ctrace)
+        child.copyGenes()
         
         return child
 
+    def selectUniformRows(self):
+        return random.sample(range(self.trace.shape[0]), int(self.trace.shape[0]/2))
+
+    def selectLayerRows(self):
+        # Inherit all the packets of randomly chosen layers, so per-layer schedules stay intact
+        layers = self.trace["layer"].unique()
+        chosen = [layer for layer in layers if random.random() < 0.5]
+        return list(np.flatnonzero(self.trace["layer"].isin(chosen).to_numpy()))
+
+    def selectRegionRows(self):
+        # Inherit the packets injected inside a random rectangle of the mesh
+        isize, jsize = self.array_shape
+        i0, i1 = sorted(random.sample(range(isize + 1), 2))
+        j0, j1 = sorted(random.sample(range(jsize + 1), 2))
+
+        src = self.trace["src"].map(lambda x: x[0]).to_numpy()
+        inside = (src // isize >= i0) & (src // isize < i1) & (src % isize >= j0) & (src % isize < j1)
+        return list(np.flatnonzero(inside))
+
+    def selectFlowGroupRows(self):
+        # Inherit the streams of randomly chosen (layer, datatype) groups, e.g. all weight broadcasts of a layer
+        groups = self.trace.groupby(["layer", "datatype"]).indices
+        chosen = [idx for idx in groups.values() if random.random() < 0.5]
+        return sorted(i for idx in chosen for i in idx)
+
+    # Block structures inherited from the left parent at crossover
+    crossover_operators = {
+        "uniform": selectUniformRows,
+        "layer": selectLayerRows,
+        "region": selectRegionRows,
+        "flow": selectFlowGroupRows,
+    }
+
+    def copyGenes(self):
+        # A deep copy of the trace keeps the lists in its cells shared, mutations change them in place
+        for col in ["intermediate", "routing"]:
+            self.trace[col] = [list(genes) for genes in self.trace[col]]
+
     def getTrace(self):
         return self.trace
 
@@ -247,20 +396,100 @@ class Individual():
         
         if self.array_size != len(path):
             path.append(random.choice(list(set(range(self.array_size)) - set(path))))
+            # the new node splits the last segment, which keeps its gene
+            sel_pkt["routing"].insert(-1, self.randomRouting())
 
     def rmImNode(self):
         sel_idx = random.choice(range(self.trace.shape[0]))
         sel_pkt = self.trace.iloc[sel_idx]
 
         if sel_pkt["intermediate"]:
-            sel_pkt["intermediate"].pop(random.choice(range(len(sel_pkt["intermediate"]))))
-        
+            rm_idx = random.choice(range(len(sel_pkt["intermediate"])))
+            sel_pkt["intermediate"].pop(rm_idx)
+            # the two segments around the removed node merge into the first one
+            sel_pkt["routing"].pop(rm_idx + 1)
+
+    def mutateRouting(self):
+        sel_idx = random.choice(range(self.trace.shape[0]))
+        sel_pkt = self.trace.iloc[sel_idx]
+
+        genes = sel_pkt["routing"]
+        genes[random.choice(range(len(genes)))] = self.randomRouting()
+
+    @staticmethod
+    def randomRouting():
+        if not gc.routing_genes:
+            return 0
+        return random.choice(range(len(routing_algorithms)))
+
+    def repairRouting(self, routers=None):
+        '''Keep the routing genes inside a deadlock-free set. The channel dependency graph starts from every 
+            packet routed by XY, the routing without genes, chaining the segments of a packet at its milestones. 
+            Packets then take their genes one by one: a segment whose gene would close a cycle falls back to the 
+            algorithm of the previous segment, and a packet that still closes one stays on XY. So the genes never 
+            add a cycle to the ones XY already makes through intermediate nodes.
+        '''
+        # XY alone is deadlock-free, and packets keeping XY would be left as they are anyway
+        if not any(any(genes) for genes in self.trace["routing"]):
+            return
+
+        routers = [algorithm(self.array_shape) for algorithm in routing_algorithms] if routers is None else routers
+        cdg = nx.DiGraph()
+
+        def update(chain, k):
+            # edges count the packets depending on them, a packet leaving its route releases them
+            for u, v in zip(chain[:-1], chain[1:]):
+                count = cdg.edges[u, v]["count"] + k if cdg.has_edge(u, v) else k
+                if count:
+                    cdg.add_edge(u, v, count=count)
+                else:
+                    cdg.remove_edge(u, v)
+
+        def route(milestones, genes):
+            # drop the output port of every milestone, the packet turns into the next segment there
+            return [routers[gene].getPath(milestones[i], milestones[i+1])[:-1] for i, gene in enumerate(genes)]
+
+        packets = []
+        for src, intermediate, dst, captain, genes in zip(self.trace["src"], self.trace["intermediate"], self.trace["dst"], 
+                                                         self.trace["captain"], self.trace["routing"]):
+            milestones = src + intermediate + (dst if pd.isna(captain) else [captain])
+            baseline = sum(route(milestones, [0] * (len(milestones) - 1)), [])
+            update(baseline, 1)
+            packets.append((milestones, list(genes), baseline))
+
+        repaired = []
+        for milestones, genes, baseline in packets:
+            if any(genes):
+                update(baseline, -1)
+                chain = []
+                for i in range(len(milestones) - 1):
+                    candidates = [genes[i]] + ([genes[i - 1]] if i > 0 else [])
+                    for gene in candidates:
+                        segment = route(milestones[i:i+2], [gene])[0]
+                        if not closes_cycle(cdg, chain[-1:] + segment):
+                            break
+                    else:
+                        update(chain, -1)
+                        genes, chain = [0] * len(genes), baseline
+                        update(chain, 1)
+                        break
+                    genes[i] = gene
+                    update(chain[-1:] + segment, 1)
+                    chain += segment
+            repaired.append(genes)
+
+        # new lists, the genes may be shared with the parents of this individual
+        self.trace["routing"] = repaired
+
     def evaluate(self):
         start_time = time()
 
+        routers = [algorithm(self.array_shape) for algorithm in routing_algorithms]
+        # Mixing routing algorithms may close a cycle of turns, which deadlocks wormhole switching
+        if gc.deadlock_check:
+            self.repairRouting(routers)
+
         working_trace = self.trace.copy()
-        
-        router = XYRouter(self.array_shape)
         for idx, row in working_trace.iterrows():
 
             path = []
@@ -268,7 +497,7 @@ class Individual():
                 milestones = row["src"] + row["intermediate"] + row["dst"]
                 # do routing
                 for i in range(len(milestones)-1):
-                    segment_path = router.getPath(milestones[i], milestones[i+1])
+                    segment_path = routers[row["routing"][i]].getPath(milestones[i], milestones[i+1])
                     # drop the output port of intermediate nodes
                     if i != len(milestones) - 1:
                         segment_path = segment_path[:-1]
@@ -276,7 +505,7 @@ class Individual():
             else:
                 milestones = row["src"] + row["intermediate"] + [row["captain"]]
                 for i in range(len(milestones) - 1):
-                    segment_path = router.getPath(milestones[i], milestones[i+1])
+                    segment_path = routers[row["routing"][i]].getPath(milestones[i], milestones[i+1])
 
                     # drop all the output port of intermedate nodes (captain is the nodes too)
                     path += segment_path[:-1]
@@ -323,3 +552,4 @@ class Individual():
         self.trace["delay"] = working_trace["delay"]
         self.trace["is_bound"] = working_trace["is_bound"]
         return score
+
@@ -1,10 +1,12 @@
 import sys
 import os
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 
 import pandas as pd
 import argparse
 import EA
+from compiler import global_control as gc
 from .individual import Individual
 from copy import deepcopy
 import numpy as np
@@ -21,7 +23,10 @@ trace = pd.read_csv(args.trace_file, header=0)
 # trace = pd.read_csv("focus/ts_scheduler/trace.dat", header=0)
 
 # ea_controller=EA.EvolutionController()
-ea_controller=EA.ParallelEvolutionController(n_workers=args.n_workers,population_size=args.population_size)
+if gc.batch_evaluate:
+    ea_controller=EA.BatchEvolutionController(population_size=args.population_size,crossover_operators=gc.crossover_operators)
+else:
+    ea_controller=EA.ParallelEvolutionController(n_workers=args.n_workers,population_size=args.population_size,crossover_operators=gc.crossover_operators)
 
 def individual_generator():
     p = Individual(deepcopy(trace),(8, 8),)
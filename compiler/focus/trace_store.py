@@ -0,0 +1,164 @@
+'''A parsed-once store for the focus traces (`buffer/focus/<task>/trace_*.json` and `solution_*.json`).
+Each json file is converted into a columnar directory next to it: scalar columns become numpy arrays,
+list columns become a flat value array plus an offset array. The arrays are memory-mapped read-only,
+so every process reading the same trace shares the pages. A store is rebuilt whenever its json changes.
+'''
+import os
+import json
+import numpy as np
+import pandas as pd
+
+from compiler.utils import columnar
+
+
+store_version = 1
+store_dirname = ".store"
+
+# kinds of stored columns
+SCALAR, STRING, LIST, NESTED_LIST, JSON = "scalar", "string", "list", "nested_list", "json"
+
+# Per-process cache: json path -> (source stamp, meta, columns)
+_stores = {}
+
+
+def get_store_dir(json_path: str) -> str:
+    parent, name = os.path.split(os.path.abspath(json_path))
+    return os.path.join(parent, store_dirname, os.path.splitext(name)[0])
+
+
+def _source_stamp(json_path: str) -> dict:
+    stat = os.stat(json_path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def _is_list_column(values) -> bool:
+    return len(values) > 0 and all(isinstance(v, list) for v in values)
+
+
+def _list_kind(flat: list):
+    is_number = lambda e: isinstance(e, (int, float)) and not isinstance(e, bool)
+    if all(isinstance(e, int) and not isinstance(e, bool) for e in flat) or \
+       all(isinstance(e, float) for e in flat):
+        return LIST
+    if all(isinstance(e, list) and all(map(is_number, e)) for e in flat) and len({len(e) for e in flat}) == 1:
+        return NESTED_LIST
+    return None
+
+
+def _encode(df: pd.DataFrame):
+    columns, layout = {}, []
+    columns["__index__"] = df.index.to_numpy()
+
+    for col_idx, name in enumerate(df.columns):
+        key = "c{}".format(col_idx)
+        series = df[name]
+        values = series.tolist()
+
+        if series.dtype != object:
+            columns[key] = series.to_numpy()
+            kind = SCALAR
+        elif all(isinstance(v, str) for v in values):
+            columns[key] = np.array(values, dtype=str)
+            kind = STRING
+        else:
+            flat = [e for v in values for e in v] if _is_list_column(values) else None
+            kind = _list_kind(flat) if flat is not None else None
+            if kind is not None:
+                columns[key + "_values"] = np.array(flat) if flat else np.zeros(0, dtype=np.int64)
+                columns[key + "_offsets"] = np.cumsum([0] + [len(v) for v in values], dtype=np.int64)
+            else:
+                # Other python objects, e.g. nullable columns, are kept as json text
+                to_json = lambda v: json.dumps(v if isinstance(v, list) or not pd.isna(v) else None)
+                columns[key] = np.array([to_json(v) for v in values], dtype=str)
+                kind = JSON
+
+        layout.append({"name": name, "key": key, "kind": kind})
+
+    return columns, layout
+
+
+def _array_names(layout: list) -> list:
+    names = ["__index__"]
+    for col in layout:
+        if col["kind"] in (LIST, NESTED_LIST):
+            names += [col["key"] + "_values", col["key"] + "_offsets"]
+        else:
+            names.append(col["key"])
+    return names
+
+
+def build(json_path: str):
+    '''Parse the json trace and (re)write its columnar store.
+    '''
+    stamp = _source_stamp(json_path)
+    df = pd.read_json(json_path)
+    columns, layout = _encode(df)
+    meta = {"version": store_version, "source": stamp, "columns": layout}
+    columnar.save_columns(get_store_dir(json_path), columns, meta)
+
+
+def _open(json_path: str):
+    json_path = os.path.abspath(json_path)
+    stamp = _source_stamp(json_path)
+
+    cached = _stores.get(json_path)
+    if cached is not None and cached[0] == stamp:
+        return cached[1], cached[2]
+
+    store_dir = get_store_dir(json_path)
+    meta = columnar.load_meta(store_dir)
+    if meta is None or meta.get("version") != store_version or meta.get("source") != stamp:
+        build(json_path)
+        meta = columnar.load_meta(store_dir)
+
+    columns = {}
+    for name in _array_names(meta["columns"]):
+        try:
+            columns.update(columnar.load_columns(store_dir, [name], mmap=True))
+        except ValueError:
+            # Empty arrays can not be memory-mapped
+            columns.update(columnar.load_columns(store_dir, [name], mmap=False))
+
+    _stores[json_path] = (stamp, meta, columns)
+    return meta, columns
+
+
+def load_columns(json_path: str) -> dict:
+    r'''Return the raw columns of a trace: name -> array for scalar columns, \
+        name -> (values, offsets) for list columns. All arrays are read-only.
+    '''
+    meta, columns = _open(json_path)
+    ret = {}
+    for col in meta["columns"]:
+        key = col["key"]
+        if col["kind"] in (LIST, NESTED_LIST):
+            ret[col["name"]] = (columns[key + "_values"], columns[key + "_offsets"])
+        else:
+            ret[col["name"]] = columns[key]
+    return ret
+
+
+def load_trace(json_path: str) -> pd.DataFrame:
+    '''A drop-in replacement of `pd.read_json` for focus traces. Each call returns a fresh DataFrame.
+    '''
+    meta, columns = _open(json_path)
+
+    data = {}
+    for col in meta["columns"]:
+        key, kind = col["key"], col["kind"]
+        if kind == SCALAR:
+            data[col["name"]] = np.array(columns[key])
+        elif kind == STRING:
+            data[col["name"]] = np.array(columns[key].tolist(), dtype=object)
+        elif kind in (LIST, NESTED_LIST):
+            values = columns[key + "_values"].tolist()
+            offsets = columns[key + "_offsets"].tolist()
+            lists = np.empty(len(offsets) - 1, dtype=object)
+            lists[:] = [values[b:e] for b, e in zip(offsets[:-1], offsets[1:])]
+            data[col["name"]] = lists
+        else:
+            objs = np.empty(len(columns[key]), dtype=object)
+            objs[:] = [np.nan if v is None else v for v in map(json.loads, columns[key].tolist())]
+            data[col["name"]] = objs
+
+    return pd.DataFrame(data, index=pd.Index(np.array(columns["__index__"])), columns=[col["name"] for col in meta["columns"]])
@@ -43,6 +43,25 @@ timeout = 60
 # Core numbers (default: number specified in database/arch/arch.yaml)
 top_level_cnt = None
 
+# -------------------- Operator Graph Specs -------------------------
+
+# Keep the generated operator graphs on disk, keyed by the dataflow reports of their layers
+op_graph_cache = True
+op_graph_cache_root = os.path.join(buffer_root, "op_graph")
+
+# Let every layer consume the output tiles of its preceeding layer as they are produced,
+# instead of waiting for the whole layer to finish
+streaming_dependency = False
+
+# Report the critical path, initiation intervals and slack of every layer under `result_root`
+pipeline_report = True
+
+# Draw the operator graph and the mapping under `visualization_root`, in a background process
+visualize = False
+# Larger graphs are drawn with one node per (layer, batch, operator type)
+visualize_max_nodes = 2000
+visualize_dpi = 200
+
 # -------------------- Task Mapper Specs -------------------------
 
 mapper_verbose = True
@@ -51,6 +70,20 @@ virtualization = True
 # mapping_style = "Zig-Zag"
 mapping_style = "Hilbert"
 
+# -------------------- Multicast Router Specs -------------------------
+
+# The router generating the branching trees of the routing board:
+# "mesh", "rpm", "whirl", "bam", "steiner", "fast_steiner",
+# or "congestion", which routes all flows against a shared link-load map
+multicast_router = "mesh"
+# Processes building multicast trees in parallel; 1 routes in the compiling process
+routing_workers = 8
+
+# Keep the routed trees on disk, shared by all tasks compiled for the same array
+tree_cache = True
+tree_cache_root = os.path.join(buffer_root, "routing_trees")
+tree_cache_entries = 200000
+
 
 # -------------------- METRO Specs -------------------------
 
@@ -61,11 +94,30 @@ scheduler_verbose = False
 n_workers = 30
 population_size = 30
 n_evolution = 50
+# Score every generation at once with `BatchEvaluator` instead of a pool of `n_workers` processes
+batch_evaluate = False
+
+# Let the genome choose a routing algorithm (XY, YX, odd-even) for every segment between milestones;
+# off until benchmarked, every evaluation then repairs the genes against channel dependency cycles
+routing_genes = False
+# The probability that a mutation step rewrites a routing gene instead of an intermediate node
+routing_mutate_prob = 0.3
+# Repair the routing genes whose turns would close a cycle of channel dependencies (see `Individual.repairRouting`)
+deadlock_check = True
+# Crossover operators drawn by the evolution controller: uniform, layer, region, flow
+crossover_operators = ["uniform", "layer", "region", "flow"]
 
 # -------------------- Spatial Simulator Specs -------------------------
 
 simulate_baseline = True
 
+# Processes building the per-PE instruction files; 1 builds them in the compiling process
+trace_workers = 8
+# Write the repeated iterations of an operator as loops over packet id strides (see `loop_trace`),
+# with bodies of up to `loop_max_period` instructions; the simulator must expand or support them
+loop_trace = False
+loop_max_period = 32
+
 # To accelerate simulation, we assume the higher clock frequency for both 
 # PEs and NoCs. 
 # This parameter reduces the packet size and computing time simultaneously.
@@ -115,4 +167,10 @@ def debug_show(item):
     exit(0)
 
 def get_ea_logpath():
-    return os.path.join(focus_buffer, taskname, "ea_output")
\ No newline at end of file
+    return os.path.join(focus_buffer, taskname, "ea_output")
+
+def get_op_graph_path():
+    return os.path.join(focus_buffer, taskname, "op_graph")
+
+def get_pipeline_report_path():
+    return os.path.join(result_root, "pipeline_{}.json".format(taskname))
\ No newline at end of file
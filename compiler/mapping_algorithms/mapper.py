@@ -2,7 +2,7 @@ from random import sample
 import networkx as nx
 import re
 from compiler import global_control
-from op_graph.micro_op_graph import MicroOpGraph
+from op_graph.micro_op_graph import MicroOpGraph, stable_hash
 from copy import deepcopy
 
 
@@ -50,7 +50,7 @@ class Mapper:
 
         get_number = lambda x: re.findall(r"\d+", x)[-1]
         get_layer = lambda x: x[:-len(get_number(x))]
-        get_val = lambda x: hash(get_layer(x)) + int(get_number(x))
+        get_val = lambda x: stable_hash(get_layer(x)) + int(get_number(x))
 
         op_priority = {"sink": 0, "insrc": 1, "wsrc": 2, "worker": 3}
         leading_op = lambda cluster: list(sorted(cluster, key=lambda x: op_priority[G.nodes[x]["op_type"]]))[0]
@@ -0,0 +1,326 @@
+'''The on-disk, array-backed export form of the operator graph.
+The compile flow builds and walks the networkx `MicroOpGraph`; `MicroOpGraph.save` exports it here, and
+tools reading a compiled task load it back without building a networkx graph. Operators and edges are rows
+of numpy columns: string attributes (`op_type`, `layer`, `edge_type`) are coded as integers into per-column
+vocabularies, and the adjacency is kept as CSR, over both the out-edges and the in-edges. A 64x64 array
+with ~1M operators takes a few hundred MB, against several GB as a networkx graph.
+'''
+import numpy as np
+import networkx as nx
+
+from compiler.utils import columnar
+
+
+store_format = "compact_op_graph"
+store_version = 1
+structure_columns = ["node", "indptr", "indices", "in_indptr", "in_edges"]
+
+
+def topological_levels(src: np.ndarray, dst: np.ndarray, n: int):
+    r'''Kahn's algorithm, one level at a time, over the edges (src[i], dst[i]) of an `n`-node DAG. \
+        Return the level of every node and, for every level, the ids of the edges whose head is on it.
+    '''
+    by_src = np.argsort(src, kind="stable")
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(src, minlength=n))])
+    indegree = np.bincount(dst, minlength=n)
+    level = np.full(n, -1, dtype=np.int64)
+    frontier, depth = np.flatnonzero(indegree == 0), 0
+    while frontier.size:
+        level[frontier] = depth
+        counts = offsets[frontier + 1] - offsets[frontier]
+        starts = np.repeat(offsets[frontier] - np.concatenate([[0], np.cumsum(counts)[:-1]]), counts)
+        heads = dst[by_src[starts + np.arange(counts.sum())]]
+        np.subtract.at(indegree, heads, 1)
+        frontier = np.unique(heads[indegree[heads] == 0])
+        depth += 1
+    if (level < 0).any():
+        raise nx.NetworkXUnfeasible("Graph contains a cycle.")
+
+    edge_level = level[dst]
+    by_level = np.argsort(edge_level, kind="stable")
+    bounds = np.searchsorted(edge_level[by_level], np.arange(depth + 1))
+    return level, [by_level[b:e] for b, e in zip(bounds[:-1], bounds[1:])]
+
+
+def encode_column(values: list):
+    r'''Encode a list of attribute values, None where absent, as a numpy column. \
+        Return (column, vocabulary, aux): strings become codes into `vocabulary`; numbers keep their dtype, \
+        with aux["integral"] marking the ints of a float column so that they come back as ints; \
+        aux["missing"] marks the absent entries, stored as -1 (codes, ints) or NaN (floats).
+    '''
+    aux = {}
+    missing = np.fromiter((v is None for v in values), dtype=bool, count=len(values))
+    if missing.any():
+        aux["missing"] = missing
+        present = [v for v in values if v is not None]
+    else:
+        present = values
+
+    if present and isinstance(present[0], str):
+        vocabulary = list(dict.fromkeys(present))
+        codes = {v: i for i, v in enumerate(vocabulary)}
+        dtype = np.int8 if len(vocabulary) < 2**7 else np.int32
+        column = np.fromiter((-1 if v is None else codes[v] for v in values), dtype=dtype, count=len(values))
+        return column, vocabulary, aux
+
+    array = np.array(present)
+    if array.dtype.kind not in "iuf":
+        array = array.astype(float)
+    if array.dtype.kind == "f":
+        integral = np.fromiter((isinstance(v, (int, np.integer)) for v in values), dtype=bool, count=len(values))
+        if integral.any():
+            aux["integral"] = integral
+    if "missing" not in aux:
+        return array, None, aux
+    column = np.full(len(values), np.nan if array.dtype.kind == "f" else -1, dtype=array.dtype)
+    column[~missing] = array
+    return column, None, aux
+
+
+def decode_column(column: np.ndarray, vocabulary=None, aux=None) -> list:
+    '''The values of a column made by `encode_column`, None where absent.
+    '''
+    aux = {} if aux is None else aux
+    values = column.tolist()
+    if vocabulary is not None:
+        values = [vocabulary[v] if v >= 0 else None for v in values]
+    for i in np.flatnonzero(aux.get("integral", [])).tolist():
+        values[i] = int(values[i])
+    for i in np.flatnonzero(aux.get("missing", [])).tolist():
+        values[i] = None
+    return values
+
+
+def append_record(columns: dict, length: int, attr: dict):
+    '''Append the attribute dict of row `length` to the column lists, padding absent attributes with None.
+    '''
+    for name, value in attr.items():
+        if name not in columns:
+            columns[name] = [None] * length
+        columns[name].append(value)
+    for column in columns.values():
+        if len(column) == length:
+            column.append(None)
+
+
+class CompactOpGraph:
+    r'''The operator graph as columns. Operators are numbered 0..n-1 in insertion order (`node` holds their \
+        ids), and edges are numbered in CSR order, i.e. grouped by tail in operator order, each tail keeping \
+        the insertion order of its edges, which is also the edge order of networkx. \
+        `node_attrs` and `edge_attrs` map attribute names to columns, `vocab` maps the names of coded \
+        columns to their vocabularies, and `aux` holds the integral / missing masks of `encode_column`.
+    '''
+
+    def __init__(self, nodes, node_attrs: dict, src, dst, edge_attrs: dict) -> None:
+        self.node = np.asarray(nodes, dtype=np.int64)
+        n = self.node.size
+        src, dst = np.asarray(src, dtype=np.int64), np.asarray(dst, dtype=np.int64)
+
+        # CSR over the out-edges, and the in-edges as edge ids grouped by head
+        order = np.argsort(src, kind="stable")
+        self.indptr = np.concatenate([[0], np.cumsum(np.bincount(src, minlength=n))])
+        self.indices = dst[order]
+        self.in_edges = np.argsort(self.indices, kind="stable")
+        self.in_indptr = np.concatenate([[0], np.cumsum(np.bincount(self.indices, minlength=n))])
+        self.src_cache, self.id_index = None, None
+
+        self.vocab, self.aux, self.meta = {}, {}, {}
+        self.node_attrs = {name: self.__encode(name, values) for name, values in node_attrs.items()}
+        self.edge_attrs = {name: self.__encode(name, values)[order] for name, values in edge_attrs.items()}
+        for name in edge_attrs:
+            self.aux[name] = {key: mask[order] for key, mask in self.aux[name].items()}
+
+    def __encode(self, name: str, values) -> np.ndarray:
+        assert name not in self.vocab and name not in self.aux, "attribute {} is on both operators and edges".format(name)
+        if isinstance(values, np.ndarray):
+            column, vocabulary, aux = values, None, {}
+        else:
+            column, vocabulary, aux = encode_column(values)
+        if vocabulary is not None:
+            self.vocab[name] = vocabulary
+        self.aux[name] = aux
+        return column
+
+    @staticmethod
+    def lookup(nodes: np.ndarray):
+        '''A vectorized map from operator ids to their positions in `nodes`.
+        '''
+        by_id = np.argsort(nodes, kind="stable")
+        sorted_ids = nodes[by_id]
+
+        def index(ids):
+            ids = np.asarray(ids, dtype=np.int64)
+            pos = np.minimum(np.searchsorted(sorted_ids, ids), max(sorted_ids.size - 1, 0))
+            if ids.size and (sorted_ids.size == 0 or (sorted_ids[pos] != ids).any()):
+                raise KeyError("unknown operator id")
+            return by_id[pos]
+        return index
+
+    @staticmethod
+    def from_networkx(G: nx.DiGraph) -> "CompactOpGraph":
+        nodes = np.fromiter(G.nodes(), dtype=np.int64, count=G.number_of_nodes())
+        index = CompactOpGraph.lookup(nodes)
+        node_attrs, edge_attrs = {}, {}
+        for i, (_, attr) in enumerate(G.nodes(data=True)):
+            append_record(node_attrs, i, attr)
+        edges = list(G.edges(data=True))
+        for i, (_, _, attr) in enumerate(edges):
+            append_record(edge_attrs, i, attr)
+        src = index([u for u, _, _ in edges])
+        dst = index([v for _, v, _ in edges])
+        return CompactOpGraph(nodes, node_attrs, src, dst, edge_attrs)
+
+    def as_networkx(self) -> nx.DiGraph:
+        r'''The equivalent `nx.DiGraph`, with the same operator, edge and attribute order, \
+            for the callers working on networkx graphs.
+        '''
+        G = nx.DiGraph()
+        ids = self.node.tolist()
+        G.add_nodes_from(zip(ids, self.__records(self.node_attrs, self.number_of_nodes())))
+        src, dst = self.node[self.edge_src].tolist(), self.node[self.indices].tolist()
+        G.add_edges_from(zip(src, dst, self.__records(self.edge_attrs, self.number_of_edges())))
+        return G
+
+    def __records(self, columns: dict, length: int) -> list:
+        decoded = {name: decode_column(column, self.vocab.get(name), self.aux[name]) for name, column in columns.items()}
+        records = [{} for _ in range(length)]
+        for name, values in decoded.items():
+            for record, value in zip(records, values):
+                if value is not None:
+                    record[name] = value
+        return records
+
+    def number_of_nodes(self) -> int:
+        return self.node.size
+
+    def number_of_edges(self) -> int:
+        return self.indices.size
+
+    @property
+    def edge_src(self) -> np.ndarray:
+        '''The tail of every edge.
+        '''
+        if self.src_cache is None:
+            self.src_cache = np.repeat(np.arange(self.number_of_nodes()), np.diff(self.indptr))
+        return self.src_cache
+
+    def index(self, ids):
+        '''The positions of operator ids.
+        '''
+        if self.id_index is None:
+            self.id_index = self.lookup(self.node)
+        return self.id_index(ids)
+
+    def successors(self, i: int) -> np.ndarray:
+        return self.indices[self.indptr[i]:self.indptr[i + 1]]
+
+    def predecessors(self, i: int) -> np.ndarray:
+        return self.edge_src[self.in_edges[self.in_indptr[i]:self.in_indptr[i + 1]]]
+
+    def out_edges(self, i: int) -> np.ndarray:
+        return np.arange(self.indptr[i], self.indptr[i + 1])
+
+    def in_edges_of(self, i: int) -> np.ndarray:
+        return self.in_edges[self.in_indptr[i]:self.in_indptr[i + 1]]
+
+    def code(self, name: str, value: str) -> int:
+        '''The code of `value` in the coded column `name`, -1 if it never occurs.
+        '''
+        vocabulary = self.vocab[name]
+        return vocabulary.index(value) if value in vocabulary else -1
+
+    def nodes_where(self, name: str, value) -> np.ndarray:
+        '''The operators whose attribute `name` equals `value`, e.g. nodes_where("op_type", "worker").
+        '''
+        if name in self.vocab:
+            value = self.code(name, value)
+        return np.flatnonzero(self.node_attrs[name] == value)
+
+    def edges_where(self, name: str, value) -> np.ndarray:
+        if name in self.vocab:
+            value = self.code(name, value)
+        return np.flatnonzero(self.edge_attrs[name] == value)
+
+    def group_nodes(self, name: str) -> dict:
+        '''Operators grouped by the value of attribute `name`, e.g. group_nodes("p_pe").
+        '''
+        column = self.node_attrs[name]
+        order = np.argsort(column, kind="stable")
+        values, starts = np.unique(column[order], return_index=True)
+        groups = np.split(order, starts[1:])
+        if name in self.vocab:
+            values = [self.vocab[name][v] if v >= 0 else None for v in values.tolist()]
+        else:
+            values = values.tolist()
+        return dict(zip(values, groups))
+
+    def compute_cycles(self) -> int:
+        '''The longest path of the graph, where every edge leaving a worker weighs its delay * cnt.
+        '''
+        n = self.number_of_nodes()
+        if n == 0:
+            return 0
+        is_worker = self.node_attrs["op_type"] == self.code("op_type", "worker")
+        weight = np.where(is_worker, self.node_attrs["delay"] * self.node_attrs["cnt"], 0)
+
+        src, dst = self.edge_src, self.indices
+        _, edges_by_level = topological_levels(src, dst, n)
+        dist = np.zeros(n, dtype=weight.dtype)
+        for edges in edges_by_level:
+            np.maximum.at(dist, dst[edges], dist[src[edges]] + weight[src[edges]])
+        return dist.max().item()
+
+    def save(self, dest_dir: str, meta=None):
+        r'''Store the graph under `dest_dir` as one .npy file per array (see `utils/columnar`), \
+            with the vocabularies, the attribute names and `meta` in the json metadata.
+        '''
+        columns = {name: getattr(self, name) for name in structure_columns}
+        columns.update({"node." + name: column for name, column in self.node_attrs.items()})
+        columns.update({"edge." + name: column for name, column in self.edge_attrs.items()})
+        for name, aux in self.aux.items():
+            columns.update({"aux.{}.{}".format(name, key): mask for key, mask in aux.items()})
+        columnar.save_columns(dest_dir, columns, {
+            "format": store_format,
+            "version": store_version,
+            "node_attrs": list(self.node_attrs),
+            "edge_attrs": list(self.edge_attrs),
+            "aux": {name: list(aux) for name, aux in self.aux.items()},
+            "vocab": self.vocab,
+            "meta": {} if meta is None else meta,
+        })
+
+    @staticmethod
+    def load(src_dir: str, mmap=True) -> "CompactOpGraph":
+        r'''Load a graph stored by `save`. With `mmap`, the arrays are read-only memory maps, \
+            paged in on first access, so that opening even a large graph takes milliseconds; \
+            load with `mmap=False` to modify the graph.
+        '''
+        meta = columnar.load_meta(src_dir)
+        if meta is None or meta.get("format") != store_format:
+            raise FileNotFoundError("no operator graph stored at {}".format(src_dir))
+        if meta["version"] != store_version:
+            raise ValueError("operator graph store version {}, expected {}".format(meta["version"], store_version))
+
+        names = structure_columns + ["node." + name for name in meta["node_attrs"]] \
+            + ["edge." + name for name in meta["edge_attrs"]] \
+            + ["aux.{}.{}".format(name, key) for name, keys in meta["aux"].items() for key in keys]
+        columns = columnar.load_columns(src_dir, names, mmap=mmap)
+
+        graph = CompactOpGraph.__new__(CompactOpGraph)
+        for name in structure_columns:
+            setattr(graph, name, columns[name])
+        graph.node_attrs = {name: columns["node." + name] for name in meta["node_attrs"]}
+        graph.edge_attrs = {name: columns["edge." + name] for name in meta["edge_attrs"]}
+        graph.aux = {name: {key: columns["aux.{}.{}".format(name, key)] for key in keys} for name, keys in meta["aux"].items()}
+        graph.vocab = meta["vocab"]
+        graph.meta = meta["meta"]
+        graph.src_cache, graph.id_index = None, None
+        return graph
+
+    def nbytes(self) -> int:
+        '''The memory held by the columns and the adjacency.
+        '''
+        arrays = [self.node, self.indptr, self.indices, self.in_indptr, self.in_edges]
+        arrays += list(self.node_attrs.values()) + list(self.edge_attrs.values())
+        arrays += [mask for aux in self.aux.values() for mask in aux.values()]
+        return sum(a.nbytes for a in arrays)
@@ -0,0 +1,75 @@
+'''An on-disk cache of generated operator graphs, shared by all compiles and processes.
+A graph is keyed by a digest of what it is built from: the dataflow reports of its layers, the batch
+number and the first flow id. Operator ids are content-derived (`stable_hash`), so the same inputs give
+the same graph in every process, and the key of a graph (`MicroOpGraph.key`) can key the caches of the
+later stages as well. Entries live under `gc.op_graph_cache_root`/v`cache_version`; bump the version
+whenever the graph construction changes.
+'''
+import os
+import json
+import pickle
+import hashlib
+import tempfile
+
+from compiler import global_control as gc
+from op_graph.micro_op_graph import MicroOpGraph
+
+
+cache_version = 1
+
+
+def get_key(reports: list, batch_num: int, flow_base: int) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(json.dumps({"version": cache_version, "batch": batch_num, "flow_base": flow_base,
+                              "streaming": gc.streaming_dependency}).encode())
+    for report in reports:
+        digest.update(report.to_json(orient="split").encode())
+    return digest.hexdigest()
+
+
+def get_path(key: str, cache_root=None) -> str:
+    cache_root = gc.op_graph_cache_root if cache_root is None else cache_root
+    return os.path.join(cache_root, "v{}".format(cache_version), key + ".pickle")
+
+
+def load(key: str, cache_root=None):
+    r'''The cached graph of `key`, None on a miss. The flow counter is moved past its flows, \
+        as if the graph had been built here.
+    '''
+    try:
+        with open(get_path(key, cache_root), "rb") as f:
+            op_graph, flow_cnt = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+    MicroOpGraph.flow_cnt = flow_cnt
+    return op_graph
+
+
+def save(key: str, op_graph: MicroOpGraph, cache_root=None):
+    path = get_path(key, cache_root)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Written aside and renamed, so concurrent compiles never read a partial file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp_", suffix=".pickle")
+    with os.fdopen(fd, "wb") as f:
+        pickle.dump((op_graph, MicroOpGraph.flow_cnt), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def build(reports: list, batch_num: int, use_cache=None) -> MicroOpGraph:
+    r'''The operator graph of the layers with dataflow `reports`, each one `batch_num` times, \
+        from the cache if it has been built before.
+    '''
+    use_cache = gc.op_graph_cache if use_cache is None else use_cache
+    key = get_key(reports, batch_num, MicroOpGraph.flow_cnt)
+    op_graph = load(key) if use_cache else None
+    if op_graph is not None:
+        print("Info: operator graph {} loaded from the cache".format(key))
+        return op_graph
+
+    op_graph = MicroOpGraph()
+    for report in reports:
+        op_graph.add_layer(report, batch_num)
+    op_graph.key = key
+    if use_cache:
+        save(key, op_graph)
+    return op_graph
@@ -1,16 +1,21 @@
 import re
+import hashlib
 import pandas as pd
 import networkx as nx
 import numpy as np
-import pandas as pd
-import copy
 import seaborn as sns
 import matplotlib.pyplot as plt
 
 from compiler import global_control as gc
+from op_graph.compact_op_graph import CompactOpGraph, topological_levels
 
 # traffic = pd.DataFrame(columns=["layer", "src", "dst", "interval", "flit", "counts"])
 
+def stable_hash(text: str) -> int:
+    '''A non-negative 63-bit digest of `text`, the same in every process, unlike the salted `hash`.
+    '''
+    return int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), "big") >> 1
+
 class MicroOpGraph:
 
     flow_cnt = 0
@@ -26,22 +31,70 @@ class MicroOpGraph:
         "map_constraint": "map_constraint"
     }
 
-    def __init__(self) -> None:
-        self.graph = nx.DiGraph()
+    def __init__(self, graph=None) -> None:
+        self.graph = nx.DiGraph() if graph is None else graph
+        # (layer, batch) -> {op_type: node} of the wsrc, insrc and sink operators
+        self.layer_index = {}
+        # layer -> the name of its preceding layer
+        self.prelayers = {}
+        # topological levels and weights for `compute_cycles`, dropped whenever the structure changes
+        self.cycle_state = None
+        # the digest of the inputs the graph was built from, see `graph_cache`
+        self.key = None
+        # layer -> the number of output tiles its sinks forward, in the streaming dependency mode
+        self.sink_tiles = {}
 
     @staticmethod
     def __hash_node(layer_, vpe_, batch_):
-        return hash(repr("{}#{}#{}".format(layer_, vpe_, batch_)))
+        return stable_hash("{}#{}#{}".format(layer_, vpe_, batch_))
 
     def get_data(self):
         return self.graph
 
+    def compact(self) -> CompactOpGraph:
+        '''The graph exported as a `CompactOpGraph`.
+        '''
+        return CompactOpGraph.from_networkx(self.graph)
+
+    def save(self, dest_dir: str):
+        '''Store the graph in the columnar format of `CompactOpGraph.save`.
+        '''
+        self.compact().save(dest_dir, {"key": self.key})
+
+    @staticmethod
+    def load(src_dir: str) -> "MicroOpGraph":
+        r'''A graph stored by `save`, back as networkx. Tools only reading the graph can use \
+            `CompactOpGraph.load` directly, which maps the arrays instead of building the graph.
+        '''
+        compact = CompactOpGraph.load(src_dir)
+        op_graph = MicroOpGraph(compact.as_networkx())
+        op_graph.key = compact.meta.get("key")
+        return op_graph
+
+    def get_prelayer_name(self, name: str) -> str:
+        '''The layer with the last number of `name` decreased by one, e.g. resnet50_layer5 -> resnet50_layer4.
+        '''
+        if name not in self.prelayers:
+            layer_number = re.findall(r"\d+", name)[-1]
+            pre_layer_number = str(int(layer_number) - 1)
+            # Replace the last occurrence only
+            self.prelayers[name] = re.sub(layer_number[::-1], pre_layer_number[::-1], name[::-1], count=1)[::-1]
+        return self.prelayers[name]
+
+    def get_layer_operator(self, layer: str, batch: int, type_: str):
+        '''The wsrc, insrc or sink operator of `layer` at `batch`, None if it has not been added.
+        '''
+        return self.layer_index.get((layer, batch), {}).get(type_)
+
     def add_layer(self, streams: pd.DataFrame, batch_num=2):
         operators = {}
 
+        # Every batch has the same structure, which is extracted from the streams only once
+        template = self.gen_layer_template(streams)
+
         # Independenlty add operators at each batch
         for b in range(batch_num):
-            op_per_batch = self.add_batch(streams, b)
+            op_per_batch = self.add_batch(streams, b, template)
             operators[b] = op_per_batch
 
         # Add a control signal between the same operator at adjacent batches: 
@@ -51,22 +104,59 @@ class MicroOpGraph:
                 # self.__add_control_edge(u, v)
                 self.add_map_constraint_edge(u, v)
 
-    def add_batch(self, streams: pd.DataFrame, batch) -> list:
+    @staticmethod
+    def gen_layer_template(streams: pd.DataFrame) -> dict:
+        r'''The batch-independent part of a layer: operator attributes, and for every worker the \
+            (fid offset, size) of its weight, input and output flows. A flow's fid is the fid base of \
+            the batch plus the position of its stream.
+        '''
+        group = streams.groupby("datatype")
+        worker_num = group.get_group("output").explode("src").shape[0]
+
+        exploded = streams.reset_index(drop=True)
+        exploded = exploded.assign(offset=np.arange(exploded.shape[0])).explode("src").explode("dst")
+        # Later streams of the same (src, dst) win, as when building a dict from the rows
+        edges = {(s, d): (o, f) for s, d, o, f in zip(exploded["src"], exploded["dst"], exploded["offset"], exploded["flit"])}
+
+        # some magic numbers ... 
+        i_source_magic, w_source_magic, sink_magic = -1, -3, -2
+        workers = range(worker_num)
+        flows = lambda src, dst: np.array([edges[(s, d)] for s, d in zip(src, dst)], dtype=object).reshape(-1, 2)
+
+        return {
+            "layer": streams["layer"][0],
+            "flow_num": streams.shape[0],
+            "worker_num": worker_num,
+            "w_cnt": group.get_group("weight")["counts"].iloc[0],
+            "w_delay": group.get_group("weight")["interval"].iloc[0],
+            "i_cnt": group.get_group("input")["counts"].iloc[0],
+            "i_delay": group.get_group("input")["interval"].iloc[0],
+            "i_data_amount": group.get_group("input")["flit"].iloc[0] * group.get_group("input")["counts"].iloc[0],
+            "o_cnt": group.get_group("output")["counts"].iloc[0],
+            "o_delay": group.get_group("output")["interval"].iloc[0],
+            "w_flows": flows([w_source_magic] * worker_num, workers),
+            "i_flows": flows([i_source_magic] * worker_num, workers),
+            "o_flows": flows(workers, [sink_magic] * worker_num),
+        }
+
+    def add_batch(self, streams: pd.DataFrame, batch, template=None) -> list:
         '''Add operators from one-batch layer to the graph
             Return: the added operator list
         '''
+        if template is None:
+            template = self.gen_layer_template(streams)
 
-        op_graph = self.graph
         operators = []
 
-        layer = streams["layer"][0]
+        layer = template["layer"]
+        worker_num = template["worker_num"]
 
         # Assign an unique id to every flow
-        streams.loc[:, "fid"] = range(MicroOpGraph.flow_cnt, MicroOpGraph.flow_cnt + streams.shape[0])
-        MicroOpGraph.flow_cnt += streams.shape[0]
-
-        group = streams.groupby("datatype")
-        worker_num = group.get_group("output").explode("src").shape[0]
+        fid_base = MicroOpGraph.flow_cnt
+        streams.loc[:, "fid"] = range(fid_base, fid_base + template["flow_num"])
+        MicroOpGraph.flow_cnt += template["flow_num"]
+        get_fids = lambda flows: (fid_base + flows[:, 0].astype(np.int64)).tolist()
+        w_fids, i_fids, o_fids = get_fids(template["w_flows"]), get_fids(template["i_flows"]), get_fids(template["o_flows"])
 
         # some magic numbers ... 
         i_source_magic, w_source_magic, sink_magic = -1, -3, -2
@@ -75,34 +165,22 @@ class MicroOpGraph:
         w_source = MicroOpGraph.__hash_node(layer, w_source_magic, batch)
         sink = MicroOpGraph.__hash_node(layer, sink_magic, batch)
 
-
-        def get_prelayer_name(name):
-            layer_number = re.findall(r"\d+", name)[-1]
-            pre_layer_number = str(int(layer_number) - 1)
-            prelayer_name = re.sub(layer_number[::-1], pre_layer_number[::-1], name[::-1])[::-1]
-            return prelayer_name
-
-        pre_layer = get_prelayer_name(layer)
-        pre_layer_sinks = nx.subgraph_view(op_graph, \
-            filter_node=lambda x: op_graph.nodes[x]["op_type"] == "sink" and op_graph.nodes[x]["layer"] == pre_layer
-                                  and op_graph.nodes[x]["batch"] == batch)
-        assert len(pre_layer_sinks.nodes) <= 1
+        pre_layer = self.get_prelayer_name(layer)
+        pre_layer_sinks = [s for s in [self.get_layer_operator(pre_layer, batch, "sink")] if s is not None]
 
         # Setup weight source
-        w_cnt = group.get_group("weight")["counts"].iloc[0]
-        w_delay = group.get_group("weight")["interval"].iloc[0]
-        self.add_node(hash_=w_source, layer=layer, type_="wsrc", v_pe=w_source_magic, delay=w_delay, count=w_cnt, batch=batch)
+        self.add_node(hash_=w_source, layer=layer, type_="wsrc", v_pe=w_source_magic, delay=template["w_delay"], count=template["w_cnt"], batch=batch)
         operators.append(w_source)
         
-        # Add Control signals: the weight source won't activate until its preceeding layer finishes
-        for s in pre_layer_sinks:
-            # op_graph.add_edge(s, w_source, edge_type="control")
-            self.add_control_edge(s, w_source)
+        # Add Control signals: the weight source won't activate until its preceeding layer finishes.
+        # Weights do not depend on the preceeding layer, so there is no such barrier when streaming.
+        if not gc.streaming_dependency:
+            for s in pre_layer_sinks:
+                # op_graph.add_edge(s, w_source, edge_type="control")
+                self.add_control_edge(s, w_source)
 
         # Setup input source
-        i_cnt = group.get_group("input")["counts"].iloc[0]
-        i_delay = group.get_group("input")["interval"].iloc[0]
-        self.add_node(hash_=i_source, layer=layer, type_="insrc", v_pe=i_source_magic, delay=i_delay, count=i_cnt, batch=batch)
+        self.add_node(hash_=i_source, layer=layer, type_="insrc", v_pe=i_source_magic, delay=template["i_delay"], count=template["i_cnt"], batch=batch)
         operators.append(i_source)
         # Add control signals: the input source should wait for preceeding layer to finish
         # TODO: We put hard syncronization bairrer between two adjacent layers. However, in some cases, e.g. oc-tiling to ic-tiling,
@@ -110,54 +188,62 @@ class MicroOpGraph:
         # generated.
 
         # FIXME: What does the sink push to next layer's isource, a control signal, or the entire output data ?
-        i_data_amount = group.get_group("input")["flit"].iloc[0] * group.get_group("input")["counts"].iloc[0]
+        # With `gc.streaming_dependency`, the sink forwards every output tile as soon as it is merged, and the
+        # input source iterations only wait for the tiles they consume (see `TraceGenerator`).
         for s in pre_layer_sinks:
-            self.add_data_edge(s, i_source, fid=MicroOpGraph.flow_cnt, size=i_data_amount)
+            size = template["i_data_amount"]
+            if gc.streaming_dependency:
+                size = int(np.ceil(size / self.sink_tiles[pre_layer]))
+            self.add_data_edge(s, i_source, fid=MicroOpGraph.flow_cnt, size=size)
             MicroOpGraph.flow_cnt += 1
 
-        # Setup sink (merger)
-        o_cnt = group.get_group("output")["counts"].iloc[0]
-        o_delay = group.get_group("output")["interval"].iloc[0]
-        self.add_node(hash_=sink, layer=layer, type_="sink", v_pe=sink_magic, delay=0, count=1, batch=batch)
+        # Setup sink (merger), one iteration per output tile when streaming
+        sink_cnt = 1
+        if gc.streaming_dependency:
+            sink_cnt = self.sink_tiles[layer] = max(int(template["o_cnt"]), 1)
+        self.add_node(hash_=sink, layer=layer, type_="sink", v_pe=sink_magic, delay=0, count=sink_cnt, batch=batch)
         operators.append(sink)
 
         # Setup workers
-        edges = {(r["src"], r["dst"]): (r["fid"], r["flit"]) for _, r in streams.explode("src").explode("dst").iterrows()}
         for w in range(worker_num):
             worker = MicroOpGraph.__hash_node(layer, w, batch)
-            self.add_node(hash_=worker, layer=layer, type_="worker", v_pe=w, delay=o_delay, count=o_cnt, batch=batch)
+            self.add_node(hash_=worker, layer=layer, type_="worker", v_pe=w, delay=template["o_delay"], count=template["o_cnt"], batch=batch)
             operators.append(worker)
 
             # Connect weight source to the worker
-            w_flow = edges[(w_source_magic, w)]
-            self.add_data_edge(w_source, worker, fid=w_flow[0], size=w_flow[1])
+            self.add_data_edge(w_source, worker, fid=w_fids[w], size=template["w_flows"][w, 1])
 
             # Connect input source to the worker
-            i_flow = edges[(i_source_magic, w)]
-            self.add_data_edge(i_source, worker, fid=i_flow[0], size=i_flow[1])
+            self.add_data_edge(i_source, worker, fid=i_fids[w], size=template["i_flows"][w, 1])
 
             # Connect the worker to sink
-            o_flow = edges[(w, sink_magic)]
-            self.add_data_edge(worker, sink, fid=o_flow[0], size=o_flow[1])
+            self.add_data_edge(worker, sink, fid=o_fids[w], size=template["o_flows"][w, 1])
 
         return operators
 
     def add_data_edge(self, u: int, v: int, fid: int, size: int):
         self.graph.add_edge(u, v, edge_type="data", fid=fid, size=size)
+        self.cycle_state = None
 
     def add_control_edge(self, u: int, v: int):
         self.graph.add_edge(u, v, edge_type="control")
+        self.cycle_state = None
     
     def add_map_constraint_edge(self, u: int, v: int):
         self.graph.add_edge(u, v, edge_type="map_constraint")
+        self.cycle_state = None
 
     def remove_edge(self, u: int, v: int):
         self.graph.remove_edge(u, v)
+        self.cycle_state = None
 
     # TODO: one function for one node type
     def add_node(self, hash_: int, type_: str, layer: int, v_pe: int, delay: int, count: int, batch: int):
         assert type_ in self.node_types
         self.graph.add_node(hash_, op_type=type_, layer=layer, v_pe=v_pe, delay=delay, cnt=count, batch=batch)
+        self.cycle_state = None
+        if type_ != "worker":
+            self.layer_index.setdefault((layer, batch), {})[type_] = hash_
 
     def set_physical_pe(self, node: int, pe: int):
         self.graph.nodes[node]["p_pe"] = pe
@@ -166,25 +252,110 @@ class MicroOpGraph:
         return self.graph.nodes[node]["op_type"]
 
     def compute_cycles(self) -> int:
-        wg = copy.deepcopy(self.graph)
-        for u, _, attr in wg.edges(data=True):
-            uattr = wg.nodes[u]
-            if uattr["op_type"] == "worker":
-                attr["cycle"] = uattr["delay"] * uattr["cnt"]
+        r'''The longest path of the graph, where every edge leaving a worker weighs its delay * cnt. \
+            The topological levels of the graph are cached until an operator or an edge is added or removed, \
+            and delays changed with `set_delay` only re-relax the levels below the earliest changed operator.
+        '''
+        if getattr(self, "cycle_state", None) is None:
+            self.cycle_state = self.__gen_cycle_state()
+        state = self.cycle_state
+
+        if state["dirty_level"] is not None:
+            dist, level, src, dst, weight = state["dist"], state["level"], state["src"], state["dst"], state["weight"]
+            first = state["dirty_level"] + 1
+            dist[level >= first] = 0
+            # edges grouped by the level of their head, every tail being on an upper level
+            for edges in state["edges_by_level"][first:]:
+                np.maximum.at(dist, dst[edges], dist[src[edges]] + weight[src[edges]])
+            state["dirty_level"] = None
+
+        return state["dist"].max().item() if state["dist"].size else 0
+
+    def set_delay(self, node, delay):
+        '''Change the delay of an operator, keeping the cached critical path consistent.
+        '''
+        nattr = self.graph.nodes[node]
+        nattr["delay"] = delay
+        state = getattr(self, "cycle_state", None)
+        if state is None:
+            return
+        i = state["index"][node]
+        value = delay * nattr["cnt"] if nattr["op_type"] == "worker" else 0
+        if state["weight"].dtype.kind == "i" and value != int(value):
+            state["weight"] = state["weight"].astype(float)
+            state["dist"] = state["dist"].astype(float)
+        state["weight"][i] = value
+        dirty = state["dirty_level"]
+        state["dirty_level"] = state["level"][i] if dirty is None else min(dirty, state["level"][i])
+
+    def __gen_cycle_state(self) -> dict:
+        G = self.graph
+        nodes = list(G.nodes())
+        index = {n: i for i, n in enumerate(nodes)}
+        n, m = len(nodes), G.number_of_edges()
+        src = np.fromiter((index[u] for u, _ in G.edges()), dtype=np.int64, count=m)
+        dst = np.fromiter((index[v] for _, v in G.edges()), dtype=np.int64, count=m)
+        weight = np.array([attr["delay"] * attr["cnt"] if attr["op_type"] == "worker" else 0 \
+                           for _, attr in G.nodes(data=True)])
+        if weight.dtype.kind not in "if":
+            weight = weight.astype(float)
+
+        level, edges_by_level = topological_levels(src, dst, n)
+
+        return {"index": index, "level": level, "src": src, "dst": dst, "weight": weight,
+                "dist": np.zeros(n, dtype=weight.dtype), "edges_by_level": edges_by_level, "dirty_level": -1}
+
+    @staticmethod
+    def layered_layout(G: nx.DiGraph) -> dict:
+        r'''Deterministic positions in one pass over the operators: a block of columns per (layer, batch), \
+            in the order layers were added, holding the sources, then the workers stacked by v_pe, then the sink.
+        '''
+        blocks, pos = {}, {}
+        sub_column = {"wsrc": 0, "insrc": 0, "worker": 1, "sink": 2}
+        for node, attr in G.nodes(data=True):
+            block = blocks.setdefault((attr["layer"], attr["batch"]), len(blocks))
+            op_type = attr["op_type"]
+            y = attr["v_pe"] if op_type == "worker" else (1 if op_type == "insrc" else 0)
+            pos[node] = (block * 4 + sub_column[op_type], -y)
+        return pos
+
+    @staticmethod
+    def aggregate(G: nx.DiGraph) -> nx.DiGraph:
+        r'''One node per (layer, batch, op_type) group, with the number of operators as "count" \
+            and the number of edges between groups as "weight".
+        '''
+        group = lambda attr: (attr["layer"], attr["batch"], attr["op_type"])
+        H = nx.DiGraph()
+        for _, attr in G.nodes(data=True):
+            key = group(attr)
+            if key not in H:
+                H.add_node(key, layer=attr["layer"], batch=attr["batch"], op_type=attr["op_type"], v_pe=0, count=0)
+            H.nodes[key]["count"] += 1
+        for u, v, edge_type in G.edges(data="edge_type"):
+            gu, gv = group(G.nodes[u]), group(G.nodes[v])
+            if H.has_edge(gu, gv):
+                H.edges[gu, gv]["weight"] += 1
             else:
-                attr["cycle"] = 0
-        # path = nx.dag_longest_path(wg, weight="cycle", default_weight=0)
-        cycle = nx.dag_longest_path_length(wg, weight="cycle", default_weight=0)
-        return cycle
+                H.add_edge(gu, gv, edge_type=edge_type, weight=1)
+        return H
 
-    def draw_graph(self, fig_path):
-        seed = 123467
+    def draw_graph(self, fig_path, max_nodes=None):
+        r'''Draw the operators with `layered_layout`. Graphs of more than `max_nodes` operators \
+            (`gc.visualize_max_nodes` by default) are drawn as their `aggregate`, labelled with group sizes.
+        '''
+        max_nodes = gc.visualize_max_nodes if max_nodes is None else max_nodes
 
         G = self.get_data()
+        aggregated = G.number_of_nodes() > max_nodes
+        if aggregated:
+            G = self.aggregate(G)
+            labels = {n: c for n, c in G.nodes(data="count")}
+        else:
+            labels = {n: int(d) for n, d in G.nodes(data="delay")}
         red_edges = [(u, v) for u, v, t in G.edges(data="edge_type") if t == "control"]
-        black_edges = [(u, v) for u, v in G.edges() if (u, v) not in red_edges]
+        black_edges = [(u, v) for u, v, t in G.edges(data="edge_type") if t != "control"]
 
-        pos = nx.spring_layout(G, seed=seed, k=0.4, iterations=20)
+        pos = self.layered_layout(G)
         node_color_map = {
             "wsrc": 0,
             "insrc": 0.25,
@@ -193,14 +364,17 @@ class MicroOpGraph:
         }
         node_color = [node_color_map[node_type] for _, node_type in G.nodes(data="op_type")]
 
+        width = max(x for x, _ in pos.values()) + 1 if pos else 1
+        height = max(-y for _, y in pos.values()) + 1 if pos else 1
+        plt.figure(figsize=(min(4 + width * 0.5, 50), min(4 + height * 0.5, 50)))
         nx.draw_networkx_nodes(G, pos, cmap=plt.get_cmap("Dark2"), node_size=500, node_color=node_color)
-        nx.draw_networkx_labels(G, pos, labels={n: int(G.nodes[n]["delay"]) for n in G.nodes()}, font_size=10)
+        nx.draw_networkx_labels(G, pos, labels=labels, font_size=10)
         nx.draw_networkx_edges(G, pos, edgelist=black_edges, arrowstyle="-|>", arrowsize=10)
         nx.draw_networkx_edges(G, pos, edgelist=red_edges, arrowstyle="-|>", arrowsize=10, edge_color="r")
 
         ax = plt.gca()
         ax.set_axis_off()
-        plt.savefig(fig_path, dpi=500)
+        plt.savefig(fig_path, dpi=gc.visualize_dpi)
         plt.close()
 
     def draw_mapping(self, fig_path):
@@ -218,8 +392,9 @@ class MicroOpGraph:
                 board[attr["p_pe"]] = value
 
         board = board.reshape((gc.array_diameter, gc.array_diameter))
-        fig = sns.heatmap(data=board, cmap="RdBu_r", linewidths=0.3, annot=True)
+        # Annotations are unreadable, and slow to draw, beyond 16x16 arrays
+        fig = sns.heatmap(data=board, cmap="RdBu_r", linewidths=0.3, annot=gc.array_diameter <= 16)
         plt.text(60, 60, "NULL: {}, CTRL: {}".format(NULL, CTRL))
         heatmap = fig.get_figure()
-        heatmap.savefig(fig_path, dpi=500)
+        heatmap.savefig(fig_path, dpi=gc.visualize_dpi)
         plt.close()
\ No newline at end of file
@@ -0,0 +1,120 @@
+'''Where the cycles of an operator graph go, to guide the core allocation of the layers.
+Over the same longest-path model as `MicroOpGraph.compute_cycles` (every edge leaving a worker weighs its
+delay * cnt), the report gives:
+  - the critical path, operator by operator, and its cycles summed by layer and by operator type;
+  - for every layer, the finish time of each batch, the steady-state initiation interval (II) between
+    consecutive batches, the II bound of its slowest worker, and its slack, i.e. how many cycles its
+    operators could be delayed without lengthening the critical path.
+'''
+import os
+import json
+import numpy as np
+
+from op_graph.micro_op_graph import MicroOpGraph
+
+
+def critical_path(op_graph: MicroOpGraph) -> list:
+    '''The operators of a longest path, from its source to its end.
+    '''
+    op_graph.compute_cycles()
+    state = op_graph.cycle_state
+    dist, src, dst, weight = state["dist"], state["src"], state["dst"], state["weight"]
+    if dist.size == 0:
+        return []
+
+    # In-edges grouped by head, to walk back along the edges that reach every operator the latest
+    by_dst = np.argsort(dst, kind="stable")
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(dst, minlength=dist.size))])
+    nodes = list(op_graph.get_data().nodes())
+
+    v = int(np.argmax(dist))
+    path = [v]
+    while offsets[v + 1] > offsets[v]:
+        preds = src[by_dst[offsets[v]:offsets[v + 1]]]
+        tight = preds[dist[preds] + weight[preds] == dist[v]]
+        if tight.size == 0:
+            break
+        v = int(tight[0])
+        path.append(v)
+    return [nodes[i] for i in reversed(path)]
+
+
+def slack(op_graph: MicroOpGraph) -> np.ndarray:
+    r'''The slack of every operator, in the order of the graph: the longest path minus the longest path \
+        through the operator.
+    '''
+    op_graph.compute_cycles()
+    state = op_graph.cycle_state
+    dist, level, src, dst, weight = state["dist"], state["level"], state["src"], state["dst"], state["weight"]
+
+    # The longest path from every operator to the end, relaxed by decreasing level of the tails
+    tail = np.zeros_like(dist)
+    by_level = np.argsort(-level[src], kind="stable")
+    splits = np.flatnonzero(np.diff(level[src][by_level])) + 1
+    for edges in np.split(by_level, splits) if src.size else []:
+        np.maximum.at(tail, src[edges], weight[src[edges]] + tail[dst[edges]])
+    return dist.max(initial=0) - (dist + tail)
+
+
+def analyze(op_graph: MicroOpGraph) -> dict:
+    G = op_graph.get_data()
+    cycles = op_graph.compute_cycles()
+    state = op_graph.cycle_state
+    index, dist, weight = state["index"], state["dist"], state["weight"]
+    slacks = slack(op_graph)
+
+    path = critical_path(op_graph)
+    by_layer, by_op_type = {}, {}
+    steps = []
+    for node in path:
+        attr, i = G.nodes[node], index[node]
+        by_layer[attr["layer"]] = by_layer.get(attr["layer"], 0) + weight[i].item()
+        op_stat = by_op_type.setdefault(attr["op_type"], {"operators": 0, "cycles": 0})
+        op_stat["operators"] += 1
+        op_stat["cycles"] += weight[i].item()
+        steps.append({"layer": attr["layer"], "batch": attr["batch"], "op_type": attr["op_type"],
+                      "v_pe": attr["v_pe"], "start": dist[i].item(), "cycles": weight[i].item()})
+
+    layers = {}
+    for node, attr in G.nodes(data=True):
+        layer = layers.setdefault(attr["layer"], {"finish": {}, "ii_bound": 0, "slack": None})
+        i = index[node]
+        if attr["op_type"] == "sink":
+            layer["finish"][attr["batch"]] = dist[i].item()
+        if attr["op_type"] == "worker":
+            layer["ii_bound"] = max(layer["ii_bound"], weight[i].item())
+        layer["slack"] = slacks[i].item() if layer["slack"] is None else min(layer["slack"], slacks[i].item())
+
+    for name, layer in layers.items():
+        finish = [layer["finish"][b] for b in sorted(layer["finish"])]
+        layer["finish"] = finish
+        # Steady state: the mean distance between the finish times of consecutive batches
+        layer["ii"] = float(np.mean(np.diff(finish))) if len(finish) > 1 else None
+        layer["critical_cycles"] = by_layer.get(name, 0)
+
+    # Only layers without slack bound the pipeline: the one spending the most cycles on the critical path,
+    # then the one with the slowest worker
+    critical = [name for name, layer in layers.items() if layer["slack"] == 0]
+    bottleneck = max(critical, key=lambda name: (layers[name]["critical_cycles"], layers[name]["ii_bound"])) \
+        if critical else None
+    assert bottleneck is None or bottleneck in by_layer, "bottleneck layer off the critical path"
+    return {
+        "cycles": cycles,
+        "bottleneck_layer": bottleneck,
+        "critical_path": {
+            "operators": len(path),
+            "by_layer": by_layer,
+            "by_op_type": by_op_type,
+            "path": steps,
+        },
+        "layers": layers,
+    }
+
+
+def dump_report(op_graph: MicroOpGraph, path: str) -> dict:
+    report = analyze(op_graph)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+        # Attributes may be numpy scalars
+        json.dump(report, f, indent=2, default=lambda x: x.item())
+    return report
@@ -2,24 +2,24 @@
 from xmlrpc.client import MAXINT
 import networkx as nx
 from router import Router
+from multicast_tree import MulticastTree
 import copy
 import random
+import heapq
 import numpy as np
 
 class MeshTreeRouter(Router):
 
+    # A tree costs less than shipping it back from a worker
+    parallel = False
+
     def __init__(self, diameter) -> None:
         super().__init__(diameter)
     
-    def route(self, source: int, dests: list) -> nx.DiGraph:
-        tree = nx.DiGraph()
+    def route(self, source: int, dests: list) -> MulticastTree:
         # Connect dests directly to the source. 
         # This is very likely to violate the spatial-sim's tree-generation rules.
-        tree.add_node(source, root=True)
-        tree.add_nodes_from(dests, root=False)
-        tree.add_edges_from((source, d) for d in dests)
-
-        return tree
+        return MulticastTree.from_edges(self.diameter, source, ((source, d) for d in dests), dests)
 
 
 
@@ -30,31 +30,8 @@ class RPMTreeRouter(Router):
     def __init__(self, diameter) -> None:
         super().__init__(diameter)
 
-    
-    def tree_pruner(self, tree, v, p_node, pp_node):
-        neighbors = nx.neighbors(tree, v)
-        if_pruned_all = True
-        if (p_node != None and pp_node != None):
-            if (p_node // self.diameter == pp_node // self.diameter) or (p_node % self.diameter == v % self.diameter):
-                if len(list(nx.neighbors(tree, p_node))) == 1 and (not tree.nodes[p_node]['dest']):
-                    tree.remove_edge(pp_node, p_node)
-                    tree.remove_edge(p_node, v)
-                    tree.remove_node(p_node)
-                    tree.add_edge(pp_node, v)
-                    p_node = pp_node
-                    if_pruned_all = False
-
-        for i in list(neighbors):
-            if not self.tree_pruner(tree, i, v, p_node):
-                if_pruned_all = False
-        return if_pruned_all
-
-        
-
-
     def get_tree(self, tree, node: int, dests: list) -> None:
         if node in dests:
-            tree.nodes[node]['dest'] = True
             dests.remove(node)
         # partition
         dests_parts = [[] for i in range(8)]
@@ -112,79 +89,42 @@ class RPMTreeRouter(Router):
 
         #add nodes
         if dests_di[0]:
-            tree.add_node(node-self.diameter, root=False)
-            tree.nodes[node-self.diameter]['dest'] = False
             tree.add_edge(node, node-self.diameter)
             self.get_tree(tree, node-self.diameter, dests_di[0])
         
         if dests_di[1]:
-            tree.add_node(node+self.diameter, root=False)
-            tree.nodes[node+self.diameter]['dest'] = False
             tree.add_edge(node, node+self.diameter)
             self.get_tree(tree, node+self.diameter, dests_di[1])
 
         if dests_di[2]:
-            tree.add_node(node-1, root=False)
-            tree.nodes[node-1]['dest'] = False
             tree.add_edge(node, node-1)
             self.get_tree(tree, node-1, dests_di[2])
 
         if dests_di[3]:
-            tree.add_node(node+1, root=False)
-            tree.nodes[node+1]['dest'] = False
             tree.add_edge(node, node+1)
             self.get_tree(tree, node+1, dests_di[3])
 
     
-    def route(self, source: int, dests: list) -> nx.DiGraph:
-        tree = nx.DiGraph()
-        tree.add_node(source, root=True)
-        self.get_tree(tree, source, dests)
-        while not self.tree_pruner(tree, source, None, None):
-            pass
+    def route(self, source: int, dests: list) -> MulticastTree:
+        tree = MulticastTree(self.diameter, source, dests)
+        self.get_tree(tree, source, list(dests))
+        tree.prune()
 
         return tree
 
 
 class WhirlTreeRouter(Router):
 
+    # Trees are drawn at random, a cached one would outlive the seed of the run
+    cacheable = False
+
     def __init__(self, diameter) -> None:
         super().__init__(diameter)
 
-    def tree_pruner(self, tree, v, p_node, pp_node):
-        neighbors = nx.neighbors(tree, v)
-        if_pruned_all = True
-        if (p_node != None and pp_node != None):
-            if (p_node // self.diameter == pp_node // self.diameter) or (p_node % self.diameter == v % self.diameter):
-                if len(list(nx.neighbors(tree, p_node))) == 1 and (not tree.nodes[p_node]['dest']):
-                    tree.remove_edge(pp_node, p_node)
-                    tree.remove_edge(p_node, v)
-                    tree.remove_node(p_node)
-                    tree.add_edge(pp_node, v)
-                    p_node = pp_node
-                    if_pruned_all = False
-
-        for i in list(neighbors):
-            if not self.tree_pruner(tree, i, v, p_node):
-                if_pruned_all = False
-        return if_pruned_all
-
-    def dest_pruner(self, tree, v, p_node):
-        neighbors = list(nx.neighbors(tree, v))
-        if_pruned_all = True
-        if len(neighbors) == 0 and p_node and (not tree.nodes[v]['dest']):
-            tree.remove_edge(p_node, v)
-            tree.remove_node(v)
-            if_pruned_all = False
-        
-        for i in neighbors:
-            if not self.dest_pruner(tree, i, v):
-                if_pruned_all = False
-        return if_pruned_all
+
     
-    def route(self, source: int, dests: list, x = -1) -> nx.DiGraph:
-        tree = nx.DiGraph()
-        tree.add_node(source, root=True)
+    def route(self, source: int, dests: list, x = -1) -> MulticastTree:
+        tree = MulticastTree(self.diameter, source, dests)
 
         if x == -1: #we allow setting x manually
             x = random.randint(0, 15) #four bit corresponding to LTBw, LTBn, LTBe, LTBs
@@ -200,16 +140,12 @@ class WhirlTreeRouter(Router):
             next_node = source + delta[i]
             while ((next_node % self.diameter == current_node % self.diameter) or (next_node // self.diameter == current_node // self.diameter)) \
                   and next_node >= 0 and next_node < self.diameter * self.diameter:
-                tree.add_node(current_node)
-                tree.add_node(next_node)
                 tree.add_edge(current_node, next_node)
                 if LTB:
                     current_node2 = next_node
                     next_node2 = current_node2 + delta[(i+1)%4]
                     while ((next_node2 % self.diameter == current_node2 % self.diameter) or (next_node2 // self.diameter == current_node2 // self.diameter))\
                           and next_node2 >= 0 and next_node2 < self.diameter * self.diameter:
-                        tree.add_node(current_node2)
-                        tree.add_node(next_node2)
                         tree.add_edge(current_node2, next_node2)
 
                         current_node2 += delta[(i+1)%4]
@@ -219,8 +155,6 @@ class WhirlTreeRouter(Router):
                     next_node2 = current_node2 + delta[(i+3)%4]
                     while ((next_node2 % self.diameter == current_node2 % self.diameter) or (next_node2 // self.diameter == current_node2 // self.diameter))\
                           and next_node2 >= 0 and next_node2 < self.diameter * self.diameter:
-                        tree.add_node(current_node2)
-                        tree.add_node(next_node2)
                         tree.add_edge(current_node2, next_node2)
 
                         current_node2 += delta[(i+3)%4]
@@ -229,51 +163,22 @@ class WhirlTreeRouter(Router):
                 current_node += delta[i]
                 next_node += delta[i]
         
-        for i in tree.nodes():
-            if i in dests:
-                tree.nodes[i]['dest'] = True
-            else:
-                tree.nodes[i]['dest'] = False
-        
-        while not self.dest_pruner(tree, source, None):
-            pass
-
-        while not self.tree_pruner(tree, source, None, None):
-            pass
+        tree.prune_leaves()
+        tree.prune()
 
         return tree
 
 
 class BAMTreeRouter(Router):
 
+    # Trees are drawn at random, a cached one would outlive the seed of the run
+    cacheable = False
+
     def __init__(self, diameter) -> None:
         super().__init__(diameter)
 
-    
-    def tree_pruner(self, tree, v, p_node, pp_node):
-        neighbors = nx.neighbors(tree, v)
-        if_pruned_all = True
-        if (p_node != None and pp_node != None):
-            if (p_node // self.diameter == pp_node // self.diameter) or (p_node % self.diameter == v % self.diameter):
-                if len(list(nx.neighbors(tree, p_node))) == 1 and (not tree.nodes[p_node]['dest']):
-                    tree.remove_edge(pp_node, p_node)
-                    tree.remove_edge(p_node, v)
-                    tree.remove_node(p_node)
-                    tree.add_edge(pp_node, v)
-                    p_node = pp_node
-                    if_pruned_all = False
-
-        for i in list(neighbors):
-            if not self.tree_pruner(tree, i, v, p_node):
-                if_pruned_all = False
-        return if_pruned_all
-
-        
-
-
     def get_tree(self, tree, node: int, dests: list) -> None:
         if node in dests:
-            tree.nodes[node]['dest'] = True
             dests.remove(node)
         # partition
         dests_parts = [[] for i in range(8)]
@@ -355,62 +260,45 @@ class BAMTreeRouter(Router):
 
         #add nodes
         if dests_di[0]:
-            tree.add_node(node-self.diameter, root=False)
-            tree.nodes[node-self.diameter]['dest'] = False
             tree.add_edge(node, node-self.diameter)
             self.get_tree(tree, node-self.diameter, dests_di[0])
         
         if dests_di[1]:
-            tree.add_node(node+self.diameter, root=False)
-            tree.nodes[node+self.diameter]['dest'] = False
             tree.add_edge(node, node+self.diameter)
             self.get_tree(tree, node+self.diameter, dests_di[1])
 
         if dests_di[2]:
-            tree.add_node(node-1, root=False)
-            tree.nodes[node-1]['dest'] = False
             tree.add_edge(node, node-1)
             self.get_tree(tree, node-1, dests_di[2])
 
         if dests_di[3]:
-            tree.add_node(node+1, root=False)
-            tree.nodes[node+1]['dest'] = False
             tree.add_edge(node, node+1)
             self.get_tree(tree, node+1, dests_di[3])
 
     
-    def route(self, source: int, dests: list) -> nx.DiGraph:
-        tree = nx.DiGraph()
-        tree.add_node(source, root=True)
-        self.get_tree(tree, source, dests)
-        while not self.tree_pruner(tree, source, None, None):
-            pass
+    def route(self, source: int, dests: list) -> MulticastTree:
+        tree = MulticastTree(self.diameter, source, dests)
+        self.get_tree(tree, source, list(dests))
+        tree.prune()
 
         return tree
 
 class Steiner_TreeRouter(Router):
+    r'''Greedy rectilinear Steiner trees: destinations are attached one by one, the closest to the tree first, \
+        by a random L-shaped path. Flows with at most `exact_threshold` destinations get an exact minimal tree instead.
+    '''
 
-    def __init__(self, diameter) -> None:
+    # translation-normalized (source, dests) pattern -> segments of its minimal tree, shared by all instances
+    exact_cache = {}
+    exact_cache_size = 100000
+
+    # Greedy trees take random L-shaped paths, a cached one would outlive the seed of the run
+    cacheable = False
+
+    def __init__(self, diameter, exact_threshold=5) -> None:
         super().__init__(diameter)
+        self.exact_threshold = exact_threshold
 
-    def tree_pruner(self, tree, v, p_node, pp_node):
-        neighbors = nx.neighbors(tree, v)
-        if_pruned_all = True
-        if (p_node != None and pp_node != None):
-            if (p_node // self.diameter == pp_node // self.diameter) or (p_node % self.diameter == v % self.diameter):
-                if len(list(nx.neighbors(tree, p_node))) == 1 and (not tree.nodes[p_node]['dest']):
-                    tree.remove_edge(pp_node, p_node)
-                    tree.remove_edge(p_node, v)
-                    tree.remove_node(p_node)
-                    tree.add_edge(pp_node, v)
-                    
-                    p_node = pp_node
-                    if_pruned_all = False
-
-        for i in list(neighbors):
-            if not self.tree_pruner(tree, i, v, p_node):
-                if_pruned_all = False
-        return if_pruned_all
     
     def p2p_distance(self, x, y):
         return abs(x // self.diameter - y // self.diameter) + abs(x % self.diameter - y % self.diameter)
@@ -421,78 +309,132 @@ class Steiner_TreeRouter(Router):
             min_dis = min(self.p2p_distance(v, x), min_dis)
         return min_dis
 
-    def add_point(self, x, tree):
-        min_dis = MAXINT
-        connect_v = None
-        for v in tree.nodes():
-            if min_dis > self.p2p_distance(v, x):
-                connect_v = v
-                min_dis = self.p2p_distance(v, x)
+    def add_point(self, x, tree, connect_v=None):
+        '''Connect `x` to the tree node `connect_v` (the nearest one by default) with a random L-shaped path.
+            Return: the nodes along the path, excluding `connect_v`
+        '''
+        if connect_v is None:
+            min_dis = MAXINT
+            for v in tree.nodes():
+                if min_dis > self.p2p_distance(v, x):
+                    connect_v = v
+                    min_dis = self.p2p_distance(v, x)
 
         temp = random.randint(0,1) #0:x-y path, 1:y-x path
         if temp:
             mid_v = x - x % self.diameter + connect_v % self.diameter
-            pre_node = connect_v
-            step = self.diameter
-            if connect_v != mid_v:
-                step = ((mid_v-connect_v)//(abs(mid_v-connect_v))) * self.diameter
-            for i in range(connect_v, mid_v, step):
-                if i != connect_v:
-                    tree.add_node(i)
-                    tree.add_edge(pre_node, i)
-                    pre_node = i
-
-            if mid_v != connect_v:
-                tree.add_node(mid_v)
-                tree.add_edge(pre_node, mid_v)
-
-            pre_node = mid_v
-            step = 1
-            if x != mid_v:
-                step = (x-mid_v)//(abs(x-mid_v))
-            for i in range(mid_v, x, step):
-                if i != mid_v:
-                    tree.add_node(i)
-                    tree.add_edge(pre_node, i)
-                    pre_node = i
-            if mid_v != x:   #to avoid add self-to-self edge
-                tree.add_node(x)
-                tree.add_edge(pre_node, x)
-
+            first_step, second_step = self.diameter, 1
         else:
             mid_v = connect_v - connect_v % self.diameter + x % self.diameter
-            pre_node = connect_v
-
-            step = 1
-            if connect_v != mid_v:
-                step = (mid_v-connect_v)//(abs(mid_v-connect_v))
-
-            for i in range(connect_v, mid_v, step):
-                if i != connect_v:
-                    tree.add_node(i)
-                    tree.add_edge(pre_node, i)
-                    pre_node = i
-            
-            if mid_v != connect_v:
-                tree.add_node(mid_v)
-                tree.add_edge(pre_node, mid_v)
-
-            pre_node = mid_v
-            step = self.diameter
-            if x != mid_v:
-                step = ((x-mid_v)//(abs(x-mid_v))) * self.diameter
-            for i in range(mid_v, x, step):
-                if i != mid_v:
-                    tree.add_node(i)
-                    tree.add_edge(pre_node, i)
-                    pre_node = i
-            if mid_v != x:
-                tree.add_node(x)
-                tree.add_edge(pre_node, x)
+            first_step, second_step = 1, self.diameter
+
+        path = [connect_v]
+        if connect_v != mid_v:
+            step = first_step if mid_v > connect_v else -first_step
+            path += list(range(connect_v + step, mid_v, step)) + [mid_v]
+        if mid_v != x:   #to avoid add self-to-self edge
+            step = second_step if x > mid_v else -second_step
+            path += list(range(mid_v + step, x, step)) + [x]
+
+        for pre_node, node in zip(path[:-1], path[1:]):
+            tree.add_edge(pre_node, node)
+        return path[1:]
     
-    def route(self, source: int, dests: list) -> nx.DiGraph:
-        tree = nx.DiGraph()
-        tree.add_node(source, root=True)
+    def route(self, source: int, dests: list) -> MulticastTree:
+        if len(set(dests) - {source}) <= self.exact_threshold:
+            return self.exact_route(source, dests)
+        return self.greedy_route(source, dests)
+
+    def exact_route(self, source: int, dests: list) -> MulticastTree:
+        d = self.diameter
+        points = [divmod(v, d) for v in [source] + sorted(set(dests) - {source})]
+        min_x, min_y = min(x for x, _ in points), min(y for _, y in points)
+        pattern = tuple((x - min_x, y - min_y) for x, y in points)
+        if pattern not in self.exact_cache:
+            if len(self.exact_cache) >= self.exact_cache_size:
+                self.exact_cache.clear()
+            self.exact_cache[pattern] = self.dreyfus_wagner(pattern)
+
+        # Lay every segment out as an L-path (x first), then take the BFS tree of their union from the source
+        adjacency = {}
+        for (x1, y1), (x2, y2) in self.exact_cache[pattern]:
+            path = [(x, y1) for x in range(x1, x2, 1 if x2 > x1 else -1)] + \
+                   [(x2, y) for y in range(y1, y2, 1 if y2 > y1 else -1)] + [(x2, y2)]
+            path = [(x + min_x) * d + y + min_y for x, y in path]
+            for u, v in zip(path[:-1], path[1:]):
+                adjacency.setdefault(u, set()).add(v)
+                adjacency.setdefault(v, set()).add(u)
+
+        tree = MulticastTree(d, source, dests)
+        frontier = [source]
+        while frontier:
+            u = frontier.pop(0)
+            for v in sorted(adjacency.get(u, ())):
+                if tree.add_edge(u, v):
+                    frontier.append(v)
+        tree.prune_leaves()
+        tree.prune()
+        return tree
+
+    @staticmethod
+    def dreyfus_wagner(points: tuple) -> list:
+        r'''The segments of a minimal rectilinear Steiner tree over `points`, the first one being the root. \
+            By Hanan's theorem it lies on the grid spanned by the point coordinates, on which the \
+            Dreyfus-Wagner dynamic program runs over the subsets of the other points. \
+            dp[S][v] is the cost of the cheapest tree joining the points of S and the grid node v.
+        '''
+        xs, ys = sorted({x for x, _ in points}), sorted({y for _, y in points})
+        nodes = [(x, y) for x in xs for y in ys]
+        index = {p: i for i, p in enumerate(nodes)}
+        node_x, node_y = np.array([x for x, _ in nodes]), np.array([y for _, y in nodes])
+        dist = np.abs(node_x[:, None] - node_x[None, :]) + np.abs(node_y[:, None] - node_y[None, :])
+
+        root, terms = index[points[0]], [index[p] for p in points[1:]]
+        k, n = len(terms), len(nodes)
+        if k == 0:
+            return []
+        full = (1 << k) - 1
+
+        dp = np.zeros((full + 1, n), dtype=np.int64)
+        move = np.zeros((full + 1, n), dtype=np.int64)    # dp[S][v] = dp[S][move] + dist(move, v)
+        split = np.zeros((full + 1, n), dtype=np.int64)   # dp[S][u] = dp[split][u] + dp[S ^ split][u]
+        for i, t in enumerate(terms):
+            dp[1 << i] = dist[t]
+            move[1 << i] = t
+
+        for S in range(1, full + 1):
+            if S & (S - 1) == 0:
+                continue
+            low = S & -S
+            best = np.full(n, np.iinfo(np.int64).max)
+            best_split = np.zeros(n, dtype=np.int64)
+            # the subsets holding the lowest point of S, so that each split is seen once
+            sub = (S - 1) & S
+            while sub:
+                if sub & low:
+                    cost = dp[sub] + dp[S ^ sub]
+                    better = cost < best
+                    best[better] = cost[better]
+                    best_split[better] = sub
+                sub = (sub - 1) & S
+            relaxed = best[:, None] + dist
+            move[S] = np.argmin(relaxed, axis=0)
+            dp[S] = relaxed[move[S], np.arange(n)]
+            split[S] = best_split
+
+        segments = []
+        stack = [(full, root)]
+        while stack:
+            S, v = stack.pop()
+            u = move[S][v]
+            if u != v:
+                segments.append((nodes[u], nodes[v]))
+            if S & (S - 1):
+                stack += [(split[S][u], u), (S ^ split[S][u], u)]
+        return segments
+
+    def greedy_route(self, source: int, dests: list) -> MulticastTree:
+        tree = MulticastTree(self.diameter, source, dests)
         dests_temp = copy.deepcopy(dests)
 
         while dests_temp:
@@ -506,19 +448,226 @@ class Steiner_TreeRouter(Router):
             self.add_point(add_p, tree)
             dests_temp.remove(add_p)
 
-        print(tree.edges())
-        for i in tree.nodes():
-            if i in dests:
-                tree.nodes[i]['dest'] = True
-            else:
-                tree.nodes[i]['dest'] = False
+        tree.prune()
+
+        return tree
+
+
+class FastSteiner_TreeRouter(Steiner_TreeRouter):
+    '''Builds the same trees as `Steiner_TreeRouter`. Instead of scanning the tree for every remaining 
+        destination at every step, it keeps the Manhattan distance field from the tree to the destinations 
+        in numpy arrays, together with the earliest-added tree node reaching that distance, and only 
+        relaxes it with the nodes added by each new path.
+    '''
+
+    def __init__(self, diameter, exact_threshold=5) -> None:
+        super().__init__(diameter, exact_threshold)
+
+    def greedy_route(self, source: int, dests: list) -> MulticastTree:
+        tree = MulticastTree(self.diameter, source, dests)
 
-        while not self.tree_pruner(tree, source, None, None):
-            pass
+        dest_arr = np.asarray(dests, dtype=np.int64)
+        dest_x, dest_y = dest_arr // self.diameter, dest_arr % self.diameter
+        in_tree = np.zeros(self.diameter * self.diameter, dtype=bool)
+        in_tree[source] = True
+
+        dist = np.abs(dest_x - source // self.diameter) + np.abs(dest_y - source % self.diameter)
+        nearest = np.full(dest_arr.shape, source, dtype=np.int64)
+        remaining = np.ones(dest_arr.shape, dtype=bool)
+
+        while remaining.any():
+            # the first remaining destination closest to the tree
+            idx = np.argmin(np.where(remaining, dist, MAXINT))
+            remaining[idx] = False
+
+            path = self.add_point(int(dest_arr[idx]), tree, int(nearest[idx]))
+            for v in path:
+                if in_tree[v]:
+                    continue
+                in_tree[v] = True
+                new_dist = np.abs(dest_x - v // self.diameter) + np.abs(dest_y - v % self.diameter)
+                closer = new_dist < dist
+                dist[closer] = new_dist[closer]
+                nearest[closer] = v
+
+        tree.prune()
 
         return tree
 
 
+class CongestionAwareRouter(Router):
+    r'''Routes every flow against a global load map of the mesh links, indexed by `pe * 4 + port` (N, S, W, E). \
+        A tree grows from the source like Prim's algorithm: each step runs a multi-source Dijkstra from the tree \
+        and attaches the destination whose path has the least loaded bottleneck link, ties broken by hop count. \
+        The links of the new branch are then charged with the flow's weight. \
+        Flows handed to `plan` are routed once, heaviest first, and `route` returns their trees.
+    '''
+
+    N, S, W, E = 0, 1, 2, 3
+
+    # Every tree depends on the load left by the previous ones
+    parallel = False
+    cacheable = False
+
+    def __init__(self, diameter) -> None:
+        super().__init__(diameter)
+        self.load = np.zeros(diameter * diameter * 4)
+        self.planned = {}
+        # the weight charged for flows which were not planned
+        self.default_weight = 1.0
+
+    def reset(self):
+        self.load[:] = 0
+        self.planned = {}
+
+    def neighbors(self, v: int):
+        d = self.diameter
+        if v >= d:
+            yield v - d, v * 4 + self.N
+        if v < d * (d - 1):
+            yield v + d, v * 4 + self.S
+        if v % d > 0:
+            yield v - 1, v * 4 + self.W
+        if v % d < d - 1:
+            yield v + 1, v * 4 + self.E
+
+    def plan(self, flows: list) -> None:
+        self.reset()
+        weights = {}
+        for source, dests, weight in flows:
+            key = (source, frozenset(dests))
+            weights[key] = weights.get(key, 0) + weight
+
+        for key in sorted(weights, key=lambda k: -weights[k]):
+            source, dests = key
+            self.planned[key] = self.build(source, sorted(dests), weights[key])
+
+    def build(self, source: int, dests: list, weight: float) -> MulticastTree:
+        tree = MulticastTree(self.diameter, source, dests)
+        remaining = set(dests) - {source}
+
+        while remaining:
+            # best (bottleneck load, hops) from the tree, and the link each node is reached by
+            best = {v: (0, 0) for v in tree.nodes()}
+            pred = {}
+            heap = [(0, 0, v) for v in best]
+            heapq.heapify(heap)
+            while heap:
+                bottleneck, hops, u = heapq.heappop(heap)
+                if (bottleneck, hops) > best[u]:
+                    continue
+                if u in remaining:
+                    break
+                for v, link in self.neighbors(u):
+                    key = (max(bottleneck, self.load[link]), hops + 1)
+                    if v not in best or key < best[v]:
+                        best[v] = key
+                        pred[v] = (u, link)
+                        heapq.heappush(heap, (key[0], key[1], v))
+
+            branch = []
+            while u not in tree:
+                p, link = pred[u]
+                branch.append((p, u, link))
+                u = p
+            for p, v, link in reversed(branch):
+                tree.add_edge(p, v)
+                self.load[link] += weight
+                remaining.discard(v)
+
+        tree.prune()
+        return tree
+
+    def route(self, source: int, dests: list) -> MulticastTree:
+        key = (source, frozenset(dests))
+        if key not in self.planned:
+            self.planned[key] = self.build(source, list(dests), self.default_weight)
+        return self.planned[key]
+
+
+class HamiltonianPathRouter(Router):
+    r'''Path-based multicast over a snake Hamiltonian labelling of the mesh (even rows left to right, odd rows \
+        right to left). Destinations labelled above the source are visited in ascending label order along one \
+        path, those below in descending order along another (dual-path). With `n_paths=4` (multi-path), each of \
+        the two sets is split again by the side of the source column, giving up to four shorter paths; a set \
+        whose two paths would cross the same PE keeps a single one, so that no path branches. \
+        Between consecutive destinations, each hop goes to the neighbor with the largest label progress \
+        not passing the target, so every path is label-monotone. Paths are returned as chains of a `MulticastTree`.
+    '''
+
+    def __init__(self, diameter, n_paths=2) -> None:
+        super().__init__(diameter)
+        assert n_paths in (2, 4)
+        self.n_paths = n_paths
+        rows, cols = np.divmod(np.arange(diameter * diameter), diameter)
+        self.label = np.where(rows % 2 == 0, rows * diameter + cols, rows * diameter + diameter - 1 - cols)
+
+    def cache_params(self) -> dict:
+        return {"n_paths": self.n_paths}
+
+    def neighbors(self, v: int) -> list:
+        d = self.diameter
+        ret = []
+        if v >= d:
+            ret.append(v - d)
+        if v < d * (d - 1):
+            ret.append(v + d)
+        if v % d > 0:
+            ret.append(v - 1)
+        if v % d < d - 1:
+            ret.append(v + 1)
+        return ret
+
+    def next_hop(self, v: int, target: int) -> int:
+        label, goal = self.label[v], self.label[target]
+        if goal > label:
+            return max((n for n in self.neighbors(v) if label < self.label[n] <= goal), key=lambda n: self.label[n])
+        return min((n for n in self.neighbors(v) if goal <= self.label[n] < label), key=lambda n: self.label[n])
+
+    def get_path(self, source: int, group: list) -> list:
+        path = [source]
+        for target in group:
+            while path[-1] != target:
+                path.append(self.next_hop(path[-1], target))
+        return path
+
+    def get_paths(self, source: int, dests: list) -> list:
+        up = sorted((d for d in set(dests) if self.label[d] > self.label[source]), key=lambda d: self.label[d])
+        down = sorted((d for d in set(dests) if self.label[d] < self.label[source]), key=lambda d: -self.label[d])
+        col = source % self.diameter
+        paths = []
+        for group in (up, down):
+            if self.n_paths == 4:
+                halves = [self.get_path(source, [d for d in group if d % self.diameter >= col]),
+                          self.get_path(source, [d for d in group if d % self.diameter < col])]
+                # Two paths of one direction may cross the same PE, where one would branch off the other
+                if not set(halves[0][1:]) & set(halves[1][1:]):
+                    paths += halves
+                    continue
+            paths.append(self.get_path(source, group))
+        return paths
+
+    def route(self, source: int, dests: list) -> MulticastTree:
+        tree = MulticastTree(self.diameter, source, dests)
+        for path in self.get_paths(source, dests):
+            for pre_node, node in zip(path[:-1], path[1:]):
+                tree.add_edge(pre_node, node)
+        tree.prune()
+        return tree
+
+
+multicast_routers = {
+    "mesh": MeshTreeRouter,
+    "rpm": RPMTreeRouter,
+    "whirl": WhirlTreeRouter,
+    "bam": BAMTreeRouter,
+    "steiner": Steiner_TreeRouter,
+    "fast_steiner": FastSteiner_TreeRouter,
+    "congestion": CongestionAwareRouter,
+    "hamiltonian": HamiltonianPathRouter,
+}
+
+
 if __name__ == "__main__":
     #router = WhirlTreeRouter(4)
     #router = RPMTreeRouter(4)
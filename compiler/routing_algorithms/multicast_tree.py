@@ -0,0 +1,132 @@
+import numpy as np
+import networkx as nx
+
+
+class MulticastTree:
+    r'''A multicast tree over the PEs of a `diameter` x `diameter` mesh, stored as a parent-index array. \
+    `parent[v]` is the parent PE of `v`, `ROOT` for the root and `ABSENT` for PEs out of the tree, \
+    `dest` is the destination bitmask and `order` keeps PEs in the order they joined the tree.
+    '''
+
+    ABSENT, ROOT = -2, -1
+
+    def __init__(self, diameter: int, root: int, dests=()) -> None:
+        self.diameter = diameter
+        self.root = root
+        self.parent = np.full(diameter * diameter, self.ABSENT, dtype=np.int64)
+        self.parent[root] = self.ROOT
+        self.dest = np.zeros(diameter * diameter, dtype=bool)
+        self.dest[list(dests)] = True
+        self.order = [root]
+
+    @staticmethod
+    def from_edges(diameter: int, root: int, edges, dests=()):
+        tree = MulticastTree(diameter, root, dests)
+        for u, v in edges:
+            tree.add_edge(u, v)
+        return tree
+
+    def __contains__(self, v) -> bool:
+        return self.parent[v] != self.ABSENT
+
+    def add_edge(self, u: int, v: int) -> bool:
+        '''Attach `v` below `u`. A PE already in the tree keeps its parent.
+        '''
+        if self.parent[v] != self.ABSENT:
+            return False
+        self.parent[v] = u
+        self.order.append(v)
+        return True
+
+    def nodes(self) -> list:
+        return [v for v in self.order if self.parent[v] != self.ABSENT]
+
+    def edges(self) -> list:
+        return [(int(self.parent[v]), v) for v in self.order if self.parent[v] >= 0]
+
+    def number_of_edges(self) -> int:
+        return int((self.parent >= 0).sum())
+
+    def link_count(self) -> int:
+        '''Physical links used by the tree: pruned edges may span several hops in a straight line or an L.
+        '''
+        v = np.flatnonzero(self.parent >= 0)
+        u = self.parent[v]
+        d = self.diameter
+        return int((np.abs(u // d - v // d) + np.abs(u % d - v % d)).sum())
+
+    def children(self) -> dict:
+        ret = {v: [] for v in self.nodes()}
+        for v in self.order:
+            if self.parent[v] >= 0:
+                ret[self.parent[v]].append(v)
+        return ret
+
+    def depth(self) -> int:
+        '''The largest number of hops from the root to a PE of the tree.
+        '''
+        d = self.diameter
+        hops = {self.root: 0}
+        stack = [self.root]
+        children = self.children()
+        while stack:
+            u = stack.pop()
+            for v in children[u]:
+                hops[v] = hops[u] + abs(u // d - v // d) + abs(u % d - v % d)
+                stack.append(v)
+        return max(hops.values())
+
+    def prune_leaves(self):
+        '''Drop leaves which are not destinations, until every leaf is a destination.
+        '''
+        children = self.children()
+        n_children = {v: len(c) for v, c in children.items()}
+        stack = [v for v, n in n_children.items() if n == 0]
+        while stack:
+            v = stack.pop()
+            p = self.parent[v]
+            if p < 0 or self.dest[v]:
+                continue
+            self.parent[v] = self.ABSENT
+            n_children[p] -= 1
+            if n_children[p] == 0:
+                stack.append(p)
+        self.order = self.nodes()
+
+    def prune(self):
+        r'''Splice out every relaying PE which is not a destination and has a single child, if it continues \
+            the row of its parent or the column of its child. Each PE is visited once in preorder; a splice \
+            re-checks the parent, whose child has changed, so the result is the fixpoint of repeated passes.
+        '''
+        d = self.diameter
+        children = self.children()
+
+        def removable(x):
+            if self.parent[x] < 0 or self.dest[x] or len(children[x]) != 1:
+                return False
+            p, c = self.parent[x], children[x][0]
+            return p // d == x // d or x % d == c % d
+
+        preorder, stack = [], [self.root]
+        while stack:
+            u = stack.pop()
+            preorder.append(u)
+            stack.extend(reversed(children[u]))
+
+        for x in preorder:
+            while self.parent[x] != self.ABSENT and removable(x):
+                p, c = self.parent[x], children[x][0]
+                self.parent[c] = p
+                children[p][children[p].index(x)] = c
+                self.parent[x] = self.ABSENT
+                del children[x]
+                x = p
+
+        self.order = self.nodes()
+
+    def to_networkx(self) -> nx.DiGraph:
+        tree = nx.DiGraph()
+        for v in self.nodes():
+            tree.add_node(v, root=(v == self.root), dest=bool(self.dest[v]))
+        tree.add_edges_from(self.edges())
+        return tree
@@ -1,9 +1,78 @@
+import random
+import hashlib
+import multiprocessing as mp
 import networkx as nx
+from multicast_tree import MulticastTree
+from compiler import global_control as gc
+
+
+def request_seed(base: int, source: int, dests) -> int:
+    '''The seed of one request: a digest of the seed of the batch and the request itself.
+    '''
+    text = "{}#{}#{}".format(base, int(source), sorted(int(d) for d in dests))
+    return int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), "little")
+
+
+def _route_seeded(router, base: int, source: int, dests: list) -> MulticastTree:
+    random.seed(request_seed(base, source, dests))
+    return router.route(source, dests)
+
+
+def _route_chunk(args):
+    router, base, requests = args
+    # Ship the edges back instead of the trees, whose arrays span the whole array
+    return [_route_seeded(router, base, source, list(dests)).edges() for source, dests in requests]
+
 
 class Router:
 
+    # Whether trees only depend on their own request, so that requests can be routed in any process and order
+    parallel = True
+
     def __init__(self, diameter) -> None:
         self.diameter = diameter
-    
-    def route(self, source: int, dests: list) -> nx.DiGraph:
-        pass
\ No newline at end of file
+
+    def plan(self, flows: list) -> None:
+        r'''Called once with every multicast flow, as (source, dests, weight) tuples, before any of them is routed. \
+            Routers building each tree independently ignore it.
+        '''
+        pass
+
+    def route(self, source: int, dests: list) -> MulticastTree:
+        pass
+
+    def route_many(self, requests: list, n_workers=None) -> list:
+        r'''Route a list of (source, dests) requests and return their trees in the same order. \
+            Identical requests share one tree. Every request is routed with its own seed, derived from the \
+            request and one draw of `random` per call, so that randomized routers give the same trees for \
+            the same global seed whatever the number of requests, workers or cores. For parallel routers, \
+            the unique requests are spread over `n_workers` processes (`gc.routing_workers` by default).
+        '''
+        keys = [(source, frozenset(dests)) for source, dests in requests]
+        unique = {}
+        for key, (source, dests) in zip(keys, requests):
+            if key not in unique:
+                unique[key] = (source, list(dests))
+
+        base = random.randrange(2**32)
+        n_workers = min(gc.routing_workers if n_workers is None else n_workers, mp.cpu_count())
+        if not self.parallel or n_workers <= 1 or len(unique) < 2 * n_workers:
+            # Seeding per request moves the global state, give the caller back the state after the draw
+            state = random.getstate()
+            trees = {key: _route_seeded(self, base, source, dests) for key, (source, dests) in unique.items()}
+            random.setstate(state)
+            return [trees[key] for key in keys]
+
+        unique_keys = list(unique.keys())
+        n_chunks = min(len(unique_keys), n_workers * 4)
+        bounds = [len(unique_keys) * i // n_chunks for i in range(n_chunks + 1)]
+        chunks = [[unique[key] for key in unique_keys[b:e]] for b, e in zip(bounds[:-1], bounds[1:])]
+
+        with mp.Pool(processes=n_workers) as pool:
+            results = pool.map(_route_chunk, [(self, base, chunk) for chunk in chunks])
+
+        trees = {}
+        for chunk, chunk_edges in zip(chunks, results):
+            for (source, dests), edges in zip(chunk, chunk_edges):
+                trees[(source, frozenset(dests))] = MulticastTree.from_edges(self.diameter, source, edges, dests)
+        return [trees[key] for key in keys]
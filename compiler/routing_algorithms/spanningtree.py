@@ -1,84 +1,111 @@
 import numpy as np
-from functools import reduce
 
 class SpanningTree():
+    r'''The BFS spanning tree of a rectangular region rooted at its captain, as (router, port) pairs. \
+    The BFS visits neighbors in the order +x, -y, -x, +y, so every node is reached by a shortest path whose \
+    parent is known in closed form: nodes in the (-x, -y) quadrant of the root hang off their x-neighbor, \
+    all others off their y-neighbor. The tree is therefore built level by level with numpy, in the BFS order, \
+    and cached by (captain, bounding box).
+    '''
 
     rotate_to_mapper = {0: 3, 1: 4, 2: 2, 3: 5, 5: 1}
 
+    # the BFS directions, and the ports of each direction followed by the local output port
+    dx = np.array([1, 0, -1, 0])
+    dy = np.array([0, -1, 0, 1])
+    ports = np.array(list(map(rotate_to_mapper.get, [0, 1, 2, 3, 5])))
+
     def __init__(self, diameter):
         self.diameter = diameter
+        self.cache = {}
 
     def wrapper_genST(self, captain, region):
         array_diameter = self.diameter
         array = np.asarray(region)
-        array_x = (array / array_diameter).astype(np.int64)
-        array_y = (array % array_diameter).astype(np.int64)
+        array_x = array // array_diameter
+        array_y = array % array_diameter
 
-        max_x, min_x = array_x.max(), array_x.min()
-        max_y, min_y = array_y.max(), array_y.min()
+        max_x, min_x = int(array_x.max()), int(array_x.min())
+        max_y, min_y = int(array_y.max()), int(array_y.min())
 
         self.x_ = [min_x, min_x, max_x, max_x]
         self.y_ = [min_y, max_y, max_y, min_y]
 
-        captain = (int(captain / array_diameter), int(captain % array_diameter))
-        raw = self.genST(captain)
+        tree = self.get_tree(int(captain), (min_x, min_y, max_x, max_y))
 
-        def transform2focus(item):
-            node, son = item
-            node_id = node[0] * array_diameter + node[1]
-            ret = [(node_id, s) for s in son]
-            return ret
+        return list(tree["pairs"]), max_y-min_y+max_x-min_x
 
-        ret = map(transform2focus, raw.items())
-        ret = reduce(lambda x, y: x + y, ret)
+    def get_tree(self, captain: int, bbox: tuple) -> dict:
+        r'''The spanning tree rooted at PE `captain` over `bbox` = (min_x, min_y, max_x, max_y). Keys: \
+            "order", the PEs in BFS order; "child", the (height, width, 4) mask of child directions; \
+            "pairs", the (router, port) pairs in BFS order, ending each router with its local port.
+        '''
+        key = (captain, ) + tuple(bbox)
+        if key not in self.cache:
+            self.cache[key] = self._build(divmod(captain, self.diameter), bbox)
+        return self.cache[key]
 
-        return ret, max_y-min_y+max_x-min_x
+    def child_ports(self, captain: int, bbox: tuple, node: int) -> list:
+        '''The ports `node` forwards to in the tree rooted at `captain`, the local port last.
+        '''
+        tree = self.get_tree(captain, bbox)
+        x, y = divmod(node, self.diameter)
+        mask = np.append(tree["child"][x - bbox[0], y - bbox[1]], True)
+        return self.ports[mask].tolist()
 
     def genST(self, root):
+        '''The per-node port lists of the tree rooted at `root` = (x, y) over the last region given to `wrapper_genST`.
+        '''
         x_, y_ = self.x_, self.y_
-        rx, ry = root
-        
-        dx = [1,0,-1,0]
-        dy = [0,-1,0,1]
-        lx, ly = x_[0], y_[0]
-        mark = np.zeros((x_[2]-x_[0]+1,y_[2]-y_[0]+1), int)
-        tree = []
-        tree.append((rx, ry))
-        mark[rx-lx][ry-ly] = 1
-        son = []
-        l = 0
-        r = 1
-
-        def out(x,y):
-            #1是在矩形内，0是在矩形外
-            if x < x_[0] or x > x_[2] or y < y_[0] or y > y_[2]:
-                return 0
-            return 1
-
-        while l < r:
-            x = tree[l][0]
-            y = tree[l][1]
-            son.append([])
-            for i in range(4):
-                xx = x + dx[i]
-                yy = y + dy[i]
-                if out(xx,yy) and mark[xx-lx][yy-ly]==0:
-                    mark[xx-lx][yy-ly] = 1
-                    son[l].append(i)
-                    tree.append((xx,yy))
-                    r += 1
-            son[l].append(5)
-            l += 1
-
-        ret = {n: [self.rotate_to_mapper[factor] for factor in s] for n, s in zip(tree, son)}
-    
+        bbox = (x_[0], y_[0], x_[2], y_[2])
+        tree = self.get_tree(root[0] * self.diameter + root[1], bbox)
+        ret = {}
+        for node, port in tree["pairs"]:
+            ret.setdefault(divmod(node, self.diameter), []).append(port)
         return ret
 
+    def _build(self, root, bbox) -> dict:
+        lx, ly, hx, hy = bbox
+        rx, ry = root
+        height, width = hx - lx + 1, hy - ly + 1
+
+        # The direction each node is entered by from its parent, -1 for the root
+        off_x = np.arange(lx, hx + 1)[:, None] - rx
+        off_y = np.arange(ly, hy + 1)[None, :] - ry
+        by_x = (off_y == 0) | ((off_x < 0) & (off_y < 0))
+        enter = np.where(by_x, np.where(off_x > 0, 0, 2), np.where(off_y > 0, 3, 1))
+        enter[rx - lx, ry - ly] = -1
+
+        # child[x, y, i]: the neighbor in direction i is entered from (x, y)
+        child = np.zeros((height, width, 4), dtype=bool)
+        for i in range(4):
+            src_x = slice(max(0, -self.dx[i]), height - max(0, self.dx[i]))
+            src_y = slice(max(0, -self.dy[i]), width - max(0, self.dy[i]))
+            dst_x = slice(max(0, self.dx[i]), height - max(0, -self.dx[i]))
+            dst_y = slice(max(0, self.dy[i]), width - max(0, -self.dy[i]))
+            child[src_x, src_y, i] = enter[dst_x, dst_y] == i
+
+        # BFS order: each level lists the children of the previous level node by node, direction by direction
+        level = [np.array([rx - lx]), np.array([ry - ly])]
+        order_x, order_y = [level[0]], [level[1]]
+        while level[0].size:
+            mask = child[level[0], level[1]]
+            level = [(level[0][:, None] + self.dx[None, :])[mask], (level[1][:, None] + self.dy[None, :])[mask]]
+            order_x.append(level[0])
+            order_y.append(level[1])
+        order_x, order_y = np.concatenate(order_x), np.concatenate(order_y)
+        order = (order_x + lx) * self.diameter + (order_y + ly)
+
+        # (router, port) pairs: the child ports of each router, then its local port
+        mask = np.concatenate([child[order_x, order_y], np.ones((order.size, 1), dtype=bool)], axis=1)
+        routers = np.broadcast_to(order[:, None], mask.shape)[mask]
+        ports = np.broadcast_to(self.ports[None, :], mask.shape)[mask]
+        pairs = list(zip(routers.tolist(), ports.tolist()))
+
+        return {"order": order, "child": child, "pairs": pairs}
+
 
 if __name__ == "__main__":
-    sp = SpanningTree()
+    sp = SpanningTree(4)
     ret = sp.wrapper_genST(0, [0, 1, 2, 8, 9, 10])
     print(ret)
-    
-    # sp = SpanningTree([(1, 1), (1, 3), (3, 3), (3, 1)])
-    # print(sp.genST((1, 1)))
\ No newline at end of file
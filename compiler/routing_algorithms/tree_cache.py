@@ -0,0 +1,150 @@
+'''A persistent, content-addressed cache of multicast trees, shared across runs, flit sizes and tasks.
+Every tree is stored as an .npy array of its edges, named by a digest of (router class, diameter,
+source, sorted destinations, router parameters), under `gc.tree_cache_root`. The last use of every tree
+is kept in memory and in an index file, read once per process and written once per `route_many`; the
+least recently used trees are evicted once the index counts more than `gc.tree_cache_entries` of them.
+'''
+import os
+import json
+import time
+import hashlib
+import tempfile
+import numpy as np
+
+from router import Router
+from multicast_tree import MulticastTree
+from compiler import global_control as gc
+
+
+cache_version = 1
+
+
+class CachedRouter(Router):
+    r'''Wraps a router with the on-disk tree cache. Routers whose trees depend on more than their request \
+        (`cacheable = False`), i.e. on the load of other flows or on random draws, bypass it.
+    '''
+
+    def __init__(self, router: Router, cache_root=None, max_entries=None) -> None:
+        super().__init__(router.diameter)
+        self.router = router
+        self.parallel = router.parallel
+        self.cache_root = gc.tree_cache_root if cache_root is None else cache_root
+        self.max_entries = gc.tree_cache_entries if max_entries is None else max_entries
+        self.hits, self.misses = 0, 0
+        # key -> time of last use, None until the index file is read
+        self.index = None
+
+    @property
+    def enabled(self) -> bool:
+        return getattr(self.router, "cacheable", True)
+
+    def get_key(self, source: int, dests: list) -> str:
+        content = {
+            "version": cache_version,
+            "router": type(self.router).__name__,
+            "diameter": self.diameter,
+            "source": int(source),
+            "dests": sorted({int(d) for d in dests}),
+            "params": self.router.cache_params() if hasattr(self.router, "cache_params") else {},
+        }
+        return hashlib.blake2b(json.dumps(content, sort_keys=True).encode(), digest_size=16).hexdigest()
+
+    def get_path(self, key: str) -> str:
+        return os.path.join(self.cache_root, key[:2], key + ".npy")
+
+    def load(self, key: str, source: int, dests: list):
+        path = self.get_path(key)
+        try:
+            edges = np.load(path, allow_pickle=False)
+        except (OSError, ValueError):
+            return None
+        return MulticastTree.from_edges(self.diameter, source, edges.tolist(), dests)
+
+    def save(self, key: str, tree: MulticastTree):
+        path = self.get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        edges = np.array(tree.edges(), dtype=np.int64).reshape(-1, 2)
+        # Written aside and renamed, so concurrent compiles never read a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp_", suffix=".npy")
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, edges, allow_pickle=False)
+        os.replace(tmp_path, path)
+
+    def get_index_path(self) -> str:
+        return os.path.join(self.cache_root, "index.json")
+
+    def read_index(self) -> dict:
+        try:
+            with open(self.get_index_path(), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def flush(self):
+        r'''Merge the last uses of this process into the index file, evict the least recently used trees \
+            beyond `max_entries`, and write the index back.
+        '''
+        # Other compiles may have added or used trees since the index was read
+        for key, used in self.read_index().items():
+            self.index[key] = max(used, self.index.get(key, used))
+
+        if len(self.index) > self.max_entries:
+            by_age = sorted(self.index, key=self.index.get)
+            for key in by_age[:len(self.index) - self.max_entries]:
+                del self.index[key]
+                try:
+                    os.remove(self.get_path(key))
+                except OSError:
+                    pass
+
+        os.makedirs(self.cache_root, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_root, prefix=".tmp_", suffix=".json")
+        with os.fdopen(fd, "w") as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.get_index_path())
+
+    def plan(self, flows: list) -> None:
+        self.router.plan(flows)
+
+    def route(self, source: int, dests: list) -> MulticastTree:
+        return self.route_many([(source, dests)])[0]
+
+    def route_many(self, requests: list, n_workers=None) -> list:
+        if not self.enabled:
+            return self.router.route_many(requests, n_workers)
+
+        if self.index is None:
+            self.index = self.read_index()
+        keys = [self.get_key(source, dests) for source, dests in requests]
+        trees = {}
+        missed = {}
+        for key, (source, dests) in zip(keys, requests):
+            if key in trees or key in missed:
+                continue
+            tree = self.load(key, source, dests)
+            if tree is None:
+                missed[key] = (source, dests)
+            else:
+                trees[key] = tree
+        self.hits += len(trees)
+        self.misses += len(missed)
+
+        if missed:
+            for key, tree in zip(missed.keys(), self.router.route_many(list(missed.values()), n_workers)):
+                self.save(key, tree)
+                trees[key] = tree
+
+        now = time.time()
+        self.index.update((key, now) for key in trees)
+        self.flush()
+        return [trees[key] for key in keys]
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def report(self):
+        if not self.enabled:
+            print("Info: {} is not cacheable, the tree cache was bypassed".format(type(self.router).__name__))
+            return
+        print("Info: tree cache hits {} / {} ({:.1%})".format(self.hits, self.hits + self.misses, self.hit_rate()))
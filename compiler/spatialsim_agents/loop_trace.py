@@ -0,0 +1,135 @@
+'''The loop-compressed form of the spatial-sim instruction files.
+An operator repeats the same instructions at every iteration, only the packet ids moving on, so runs of
+iterations are written once as a loop body:
+
+    loop 64
+    assemble # NI.recv 120+3
+    assemble # CPU.sleep 436
+    assemble # NI.send 121+3 5 6
+    endloop
+
+where `pid+stride` is the packet id at the first pass, growing by `stride` at every pass. A body holds
+up to `gc.loop_max_period` instructions, and may span several iterations (e.g. a recv every 4th
+iteration). `expand` streams the compressed form back to the flat one, line for line identical to an
+uncompressed trace.
+
+Usage, to expand the c*.inst files of a task in place:
+    PYTHONPATH=. python compiler/spatialsim_agents/loop_trace.py <task_dir>
+'''
+import os
+import sys
+import glob
+
+root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+if root not in sys.path:
+    sys.path.append(root)
+
+from compiler import global_control as gc
+
+
+loop_begin = "loop"
+loop_end = "endloop"
+# Instructions carrying a packet id as their 4th token
+pid_instructions = {"NI.recv", "NI.send"}
+
+
+def parse(instr: str) -> tuple:
+    r'''The shape of an instruction, i.e. its tokens with the packet id blanked, and its packet id (None if it has none).
+    '''
+    tokens = instr.split(" ")
+    if len(tokens) > 3 and tokens[2] in pid_instructions:
+        pid = int(tokens[3])
+        tokens[3] = None
+        return tuple(tokens), pid
+    return tuple(tokens), None
+
+
+def compress(instruction_list: list, max_period=None) -> list:
+    r'''The lines of an operator's iterations (one list of instructions per iteration), every run of \
+        at least two repeats of a body of up to `max_period` instructions written as a loop. Bodies are \
+        found on the flattened instructions, so that they may span several iterations, e.g. when a tensor \
+        is received every 4th iteration, or a part of one, e.g. the receives of a sink from all its workers.
+    '''
+    max_period = gc.loop_max_period if max_period is None else max_period
+    instrs = [instr for it in instruction_list for instr in it]
+    parsed = [parse(instr) for instr in instrs]
+    shapes = [shape for shape, _ in parsed]
+    pids = [0 if pid is None else pid for _, pid in parsed]
+    n = len(instrs)
+
+    def repeats_of(i, period):
+        if shapes[i:i + period] != shapes[i + period:i + 2 * period]:
+            return 1, None
+        strides = [b - a for a, b in zip(pids[i:i + period], pids[i + period:i + 2 * period])]
+        repeats = 2
+        while i + (repeats + 1) * period <= n:
+            j = i + repeats * period
+            if shapes[j:j + period] != shapes[i:i + period] \
+                    or any(b - a != s for a, b, s in zip(pids[j - period:j], pids[j:j + period], strides)):
+                break
+            repeats += 1
+        return repeats, strides
+
+    lines = []
+    i = 0
+    while i < n:
+        best = (1, 1, None)
+        for period in range(1, min(max_period, (n - i) // 2) + 1):
+            repeats, strides = repeats_of(i, period)
+            if period * repeats > best[0] * best[1]:
+                best = (period, repeats, strides)
+
+        period, repeats, strides = best
+        if repeats < 2:
+            lines.append(instrs[i])
+            i += 1
+            continue
+
+        lines.append("{} {}".format(loop_begin, repeats))
+        for (shape, pid), stride in zip(parsed[i:i + period], strides):
+            lines.append(" ".join("{}+{}".format(pid, stride) if t is None else t for t in shape))
+        lines.append(loop_end)
+        i += period * repeats
+    return lines
+
+
+def expand(lines):
+    r'''Stream the flat lines of (possibly) loop-compressed lines. Lines keep their line ends, if any.
+    '''
+    body, repeats = None, 0
+    for line in lines:
+        stripped = line.rstrip("\n")
+        if body is None:
+            if stripped.startswith(loop_begin + " "):
+                body, repeats = [], int(stripped.split(" ")[1])
+            else:
+                yield line
+            continue
+        if stripped != loop_end:
+            body.append((line[len(stripped):], stripped.split(" ")))
+            continue
+
+        for k in range(repeats):
+            for end, tokens in body:
+                if len(tokens) > 3 and tokens[2] in pid_instructions:
+                    pid, stride = tokens[3].split("+")
+                    tokens = tokens[:3] + [str(int(pid) + k * int(stride))] + tokens[4:]
+                yield " ".join(tokens) + end
+        body = None
+    assert body is None, "unterminated loop"
+
+
+def expand_file(src_path: str, dest_path: str):
+    '''Expand a compressed instruction file, written aside and renamed so that `dest_path` may be `src_path`.
+    '''
+    tmp_path = dest_path + ".tmp"
+    with open(src_path, "r") as src, open(tmp_path, "w") as dest:
+        dest.writelines(expand(src))
+    os.replace(tmp_path, dest_path)
+
+
+if __name__ == "__main__":
+    for task_dir in sys.argv[1:]:
+        for path in sorted(glob.glob(os.path.join(task_dir, "c*.inst"))):
+            expand_file(path, path)
+            print("Expanded", path)
@@ -1,6 +1,7 @@
 import os
 import pandas as pd
 from compiler import global_control as gc
+from compiler.focus import trace_store
 
 # FIXME: 
 class Analyzer:
@@ -23,7 +24,7 @@ class Analyzer:
         return result
     
     def getFocusResult(self):
-        result = pd.read_json(
+        result = trace_store.load_trace(
             os.path.join(gc.focus_buffer, gc.taskname, "solution_{}.json".format(gc.flit_size))
         )
 
@@ -1,4 +1,5 @@
 import networkx as nx
+import multiprocessing as mp
 from copy import deepcopy
 
 from op_graph.micro_op_graph import MicroOpGraph
@@ -6,8 +7,23 @@ from routing_algorithms import router
 from io import TextIOWrapper
 from variables import Variables
 from compiler import global_control as gc
+from compiler.spatialsim_agents import loop_trace
 import re
 
+# (generator, op_graph, nodes_on_pe) of the emission pool, inherited by its workers
+_emission = None
+
+
+def _init_emission(generator, op_graph, nodes_on_pe):
+    global _emission
+    _emission = (generator, op_graph, nodes_on_pe)
+
+
+def _emit_pes(pes):
+    generator, op_graph, nodes_on_pe = _emission
+    return [generator.gen_pe_operators(op_graph, nodes_on_pe[pe]) for pe in pes]
+
+
 class TraceGenerator:
     '''Act as the driver for spatial-simulator.
     '''
@@ -28,15 +44,15 @@ class TraceGenerator:
         op_graph = deepcopy(graph.get_data())
 
         # Operator field
-        for f in trace_to.values():
-            print("operators:", file=f)
         # self.__gen_serial_op_field(trace_to, op_graph)
-        self.__gen_parallel_op_field(trace_to, op_graph)
+        operators = self.__gen_parallel_op_field(trace_to, op_graph)
 
         # Data field
-        for f in trace_to.values():
-            print("\n\ndata:", file=f)
-        self.__gen_data_field(trace_to, op_graph)
+        data = self.__gen_data_field(trace_to, op_graph)
+
+        # Every file in one write
+        for pe, f in trace_to.items():
+            f.write("operators:\n" + operators[pe] + "\n\ndata:\n" + data[pe])
 
         # Multicast tree
         self.__gen_routing_board(routing_board_to, op_graph, router)
@@ -75,24 +91,32 @@ class TraceGenerator:
         data_pkt_endpoints = self.__get_pkt_endpoints(op_graph, "data")
         node2pe = lambda x: op_graph.nodes[x]["p_pe"]
 
-        cache = {}
+        # Let routers sharing state across flows see all of them first, each weighted by its size / interval
+        flows = {}
+        for endpoints in data_pkt_endpoints.values():
+            if len(endpoints["dst"]) != 1 and endpoints["fid"] not in flows:
+                src, dst = endpoints["src"], endpoints["dst"]
+                weight = op_graph.edges[src, dst[0]]["size"] / max(op_graph.nodes[src]["delay"], 1)
+                flows[endpoints["fid"]] = (node2pe(src), list(map(node2pe, dst)), weight)
+        router.plan(list(flows.values()))
+
+        trees = router.route_many([(src, dsts) for src, dsts, _ in flows.values()])
+        trees = dict(zip(flows.keys(), trees))
+
         for pid, endpoints in data_pkt_endpoints.items():
             # Ignore unicast packets
             if len(endpoints["dst"]) == 1:
                 continue
-            if endpoints["fid"] not in cache:
-                src = node2pe(endpoints["src"])
-                dsts = list(map(node2pe, endpoints["dst"]))
-                mc_tree = router.route(src, dsts)
-                cache[endpoints["fid"]] = mc_tree
-            else:
-                mc_tree = cache[endpoints["fid"]]
+            src, dsts, _ = flows[endpoints["fid"]]
+            mc_tree = trees[endpoints["fid"]]
             print("{} {} {}".format(pid, src, " ".join(map(str, dsts))), file=to)
             for seg_src, seg_dst in mc_tree.edges():
                 print("{} {}".format(seg_src, seg_dst), file=to)
             print("\n", file=to)
 
-    def __gen_data_field(self, to: dict, op_graph: nx.DiGraph):
+    def __gen_data_field(self, to: dict, op_graph: nx.DiGraph) -> dict:
+        lines = {pe: [] for pe in to}
+
         # generate data packets
         data_pkt_tuples = self.__get_pkt_endpoints(op_graph, "data")
         for pid, pkt_endpoints in data_pkt_tuples.items():
@@ -101,7 +125,7 @@ class TraceGenerator:
             size = op_graph.edges[src, dsts[0]]["size"]
             src_core = op_graph.nodes[src]["p_pe"]
             dst_cores = map(lambda x: op_graph.nodes[x]["p_pe"], dsts)
-            print("{} # {} # {}".format(pid, ", ".join(map(str, dst_cores)), size), file=to[src_core])
+            lines[src_core].append("{} # {} # {}\n".format(pid, ", ".join(map(str, dst_cores)), size))
 
         # generate control packets
         control_pkt_tuples = self.__get_pkt_endpoints(op_graph, "control")
@@ -111,8 +135,9 @@ class TraceGenerator:
             src, dsts = pkt_endpoints["src"], pkt_endpoints["dst"]
             src_core = op_graph.nodes[src]["p_pe"]
             dst_cores = map(lambda x: op_graph.nodes[x]["p_pe"], dsts)
-            print("{} # {} # {}".format(pid, ", ".join(map(str, dst_cores)), size), file=to[src_core])
+            lines[src_core].append("{} # {} # {}\n".format(pid, ", ".join(map(str, dst_cores)), size))
 
+        return {pe: "".join(pe_lines) for pe, pe_lines in lines.items()}
 
     def __gen_serial_op_field(self, to: dict, op_graph: nx.DiGraph):
 
@@ -188,14 +213,38 @@ class TraceGenerator:
                 print(inst, file=instrs[nattr["p_pe"]])
 
 
-    def __gen_parallel_op_field(self, to: dict, op_graph: nx.DiGraph):
+    def __gen_parallel_op_field(self, to: dict, op_graph: nx.DiGraph) -> dict:
+        r'''The operator field of every PE. Packet ids are assigned to the edges in one pass over the graph, \
+            after which the instruction streams of the PEs are independent, and are built in `gc.trace_workers` \
+            processes.
+        '''
 
         assert nx.is_directed_acyclic_graph(op_graph)
         for _, __, eattr in op_graph.edges(data=True):
             eattr["pkt"] = []
             eattr["vis"] = False
 
-        pf = self.prefix
+        self.__assign_pids(to, op_graph)
+
+        # The operators of every PE, in the order of the graph
+        nodes_on_pe = {pe: [] for pe in range(gc.array_size)}
+        for node, pe in op_graph.nodes(data="p_pe"):
+            nodes_on_pe[pe].append(node)
+
+        pes = list(range(gc.array_size))
+        n_workers = min(gc.trace_workers, mp.cpu_count(), len(pes))
+        if n_workers <= 1:
+            return {pe: self.gen_pe_operators(op_graph, nodes_on_pe[pe]) for pe in pes}
+
+        # PEs dealt round-robin, neighbouring PEs often holding the same amount of operators
+        chunks = [pes[i::n_workers * 4] for i in range(n_workers * 4)]
+        with mp.Pool(processes=n_workers, initializer=_init_emission, initargs=(self, op_graph, nodes_on_pe)) as pool:
+            results = pool.map(_emit_pes, chunks)
+        return {pe: text for chunk, texts in zip(chunks, results) for pe, text in zip(chunk, texts)}
+
+    def __assign_pids(self, to: dict, op_graph: nx.DiGraph):
+        '''Give every iteration of every flow leaving a PE its packet id, in topological order.
+        '''
         instrs = to
         node2pe = lambda x: op_graph.nodes[x]["p_pe"]
 
@@ -227,82 +276,160 @@ class TraceGenerator:
                 op_graph.edges[u, v]["pkt"].append(pid)
                 op_graph.edges[u, v]["vis"] = True
 
-        for pe in range(gc.array_size):
-            tasks_on_pe = nx.subgraph_view(op_graph, filter_node=lambda x: node2pe(x) == pe)
-            for serial_tasks in nx.weakly_connected_components(tasks_on_pe):
-                print("{", file=instrs[pe])
-
-                # TODO: Some hacks: To enable pipeline, the operators at batch T should be issued before 
-                # the operators at batch T + 1. 
-
-                serial_graph = nx.DiGraph(nx.subgraph(op_graph, serial_tasks))
-                # org = len(serial_graph.edges())
-                # To Add an dummy edge from sink-T to insrc-T+1
-                for n1 in serial_graph.nodes:
-                    for n2 in serial_graph.nodes:
-                        n1attr, n2attr = op_graph.nodes[n1], op_graph.nodes[n2]
-                        if n1attr["op_type"] == "insrc" and n2attr["op_type"] == "sink" and n1attr["batch"] == n2attr["batch"] - 1:
-                            serial_graph.add_edge(n1, n2)
-                # added = len(serial_graph.edges())
-                # if (org != added):
-                #     print(org, added)
-                #     for node in nx.topological_sort(serial_graph):
-                #         print(op_graph.nodes[node]["op_type"], op_graph.nodes[node]["layer"], op_graph.nodes[node]["batch"])
-                #     exit(0)
-
-                for node in nx.topological_sort(serial_graph):
-                    nattr = op_graph.nodes[node]
-                    iteraction_cnt = int(nattr["cnt"])
-
-                    # actions per iteration
-                    instruction_list = [[] for _ in range(iteraction_cnt)]
-
-                    # First, the operation consumes its dependent data and control signals if necessary
-                    for u, v, eattr in op_graph.in_edges(node, data=True):
-                        if node2pe(u) != node2pe(v):
-                            if eattr["edge_type"] == "data":
-                                self.__observe_dependent_data(eattr["pkt"], instruction_list, pf["recv"])
-                            elif eattr["edge_type"] == "control":
-                                self.__observe_sync_signal(eattr["pkt"], instruction_list, pf["sync"])
-
-                    # Second, the operator will occupy the CPU for several cycles to compute at each iteration
-                    for it in instruction_list:
-                        it.append("{} {:.0f}".format(pf["comp"], nattr["delay"] / gc.overclock))
-
-                    # Third, the operation will generate an output tensor at arch iteration
-                    # We ignore the packet sent to the node itself
-                    out_data_edges = [(u, v, eattr) for u, v, eattr in op_graph.out_edges(node, data=True) \
-                                                         if eattr["edge_type"] == "data" and node2pe(u) != node2pe(v)]
-                    multicast_flows = {}
-                    for u, v, eattr in out_data_edges:
-                        if eattr["fid"] not in multicast_flows:
-                            multicast_flows[eattr["fid"]] = []
-                        multicast_flows[eattr["fid"]].append((u, v))
-
-                    get_pkt = lambda u, v, idx: op_graph.edges[u, v]["pkt"][idx]
-                    for it, idx in zip(instruction_list, range(len(instruction_list))):
-                        for flows in multicast_flows.values():
-                            pids = [get_pkt(u, v, idx) for u, v in flows]
-                            assert len(set(pids)) == 1
-                            dests = [str(node2pe(v)) for u, v in flows]
-                            it.append("{} {:.0f} {}".format(pf["send"], pids[0], " ".join(dests)))
-
-                    # Finally, the operator send a finish signal at each sync-edge
-                    out_control_edges = [(u, v, eattr) for u, v, eattr in op_graph.out_edges(node, data=True) \
-                                                            if eattr["edge_type"] == "control" and node2pe(u) != node2pe(v)]
-                    for u, v, eattr in out_control_edges:
-                        assert len(eattr["pkt"]) == 1
-                        if eattr["pkt"][0] == 161:
-                            print("aa")
-                        instruction_list[-1].append("{} {:.0f} {}".format(pf["send"], eattr["pkt"][0], node2pe(v)))
-
-                    # Write to the trace file
-                    collapse = [instr for step in instruction_list for instr in step]
-                    for inst in collapse:
-                        print(inst, file=instrs[pe])
-
-                print("}", file=instrs[pe])
+    def gen_pe_operators(self, op_graph: nx.DiGraph, nodes: list) -> str:
+        '''The operator field of the PE holding `nodes`, once packet ids are assigned.
+        '''
+        lines = []
+        for serial_tasks in self.__weakly_connected_components(op_graph, nodes):
+            lines.append("{")
+
+            # TODO: Some hacks: To enable pipeline, the operators at batch T should be issued before 
+            # the operators at batch T + 1. 
+
+            serial_graph = nx.DiGraph(nx.subgraph(op_graph, serial_tasks))
+            # To Add an dummy edge from insrc-T to every sink-T+1, the sinks looked up by batch
+            sinks_by_batch = {}
+            for n in serial_graph.nodes:
+                if op_graph.nodes[n]["op_type"] == "sink":
+                    sinks_by_batch.setdefault(op_graph.nodes[n]["batch"], []).append(n)
+            for n1 in serial_graph.nodes:
+                n1attr = op_graph.nodes[n1]
+                if n1attr["op_type"] == "insrc":
+                    for n2 in sinks_by_batch.get(n1attr["batch"] + 1, []):
+                        serial_graph.add_edge(n1, n2)
+
+            order = list(nx.topological_sort(serial_graph))
+            # Sinks interleaved with the input sources they stream to, on the same PE
+            streams_to = self.__get_streaming_pairs(op_graph, serial_graph, order) if gc.streaming_dependency else {}
+            merged = set(streams_to.values())
+
+            for node in order:
+                if node in merged:
+                    continue
+                instruction_list = self.__gen_op_instructions(op_graph, node)
+                if node in streams_to:
+                    instruction_list = self.__interleave(instruction_list, \
+                        self.__gen_op_instructions(op_graph, streams_to[node]))
+
+                if gc.loop_trace:
+                    lines += loop_trace.compress(instruction_list)
+                else:
+                    lines += [instr for step in instruction_list for instr in step]
+
+            lines.append("}")
+
+        return "".join(line + "\n" for line in lines)
+
+    def __weakly_connected_components(self, op_graph: nx.DiGraph, nodes: list):
+        r'''`nx.weakly_connected_components` of the operators `nodes` of one PE, visiting only their own edges. \
+            The sets are built as networkx builds them on a node-filtered view, since the order of the \
+            emitted instructions depends on their iteration order.
+        '''
+        if not nodes:
+            return
+        pe = op_graph.nodes[nodes[0]]["p_pe"]
+        same_pe = lambda x: op_graph.nodes[x]["p_pe"] == pe
+
+        def bfs(source):
+            seen, nextlevel = set(), {source}
+            while nextlevel:
+                thislevel, nextlevel = nextlevel, set()
+                for v in thislevel:
+                    if v not in seen:
+                        seen.add(v)
+                        nextlevel.update(n for n in op_graph.succ[v] if same_pe(n))
+                        nextlevel.update(n for n in op_graph.pred[v] if same_pe(n))
+                        yield v
+
+        seen = set()
+        for source in nodes:
+            if source not in seen:
+                component = set(bfs(source))
+                seen.update(component)
+                yield component
+
+    def __gen_op_instructions(self, op_graph: nx.DiGraph, node) -> list:
+        '''The instructions of every iteration of `node`, as one list per iteration.
+        '''
+        pf = self.prefix
+        node2pe = lambda x: op_graph.nodes[x]["p_pe"]
+
+        nattr = op_graph.nodes[node]
+        iteraction_cnt = int(nattr["cnt"])
 
+        # actions per iteration
+        instruction_list = [[] for _ in range(iteraction_cnt)]
+
+        # First, the operation consumes its dependent data and control signals if necessary
+        for u, v, eattr in op_graph.in_edges(node, data=True):
+            if node2pe(u) != node2pe(v):
+                if eattr["edge_type"] == "data":
+                    self.__observe_dependent_data(eattr["pkt"], instruction_list, pf["recv"])
+                elif eattr["edge_type"] == "control":
+                    self.__observe_sync_signal(eattr["pkt"], instruction_list, pf["sync"])
+
+        # Second, the operator will occupy the CPU for several cycles to compute at each iteration
+        for it in instruction_list:
+            it.append("{} {:.0f}".format(pf["comp"], nattr["delay"] / gc.overclock))
+
+        # Third, the operation will generate an output tensor at arch iteration
+        # We ignore the packet sent to the node itself
+        out_data_edges = [(u, v, eattr) for u, v, eattr in op_graph.out_edges(node, data=True) \
+                                             if eattr["edge_type"] == "data" and node2pe(u) != node2pe(v)]
+        multicast_flows = {}
+        for u, v, eattr in out_data_edges:
+            if eattr["fid"] not in multicast_flows:
+                multicast_flows[eattr["fid"]] = []
+            multicast_flows[eattr["fid"]].append((u, v))
+
+        get_pkt = lambda u, v, idx: op_graph.edges[u, v]["pkt"][idx]
+        for it, idx in zip(instruction_list, range(len(instruction_list))):
+            for flows in multicast_flows.values():
+                pids = [get_pkt(u, v, idx) for u, v in flows]
+                assert len(set(pids)) == 1
+                dests = [str(node2pe(v)) for u, v in flows]
+                it.append("{} {:.0f} {}".format(pf["send"], pids[0], " ".join(dests)))
+
+        # Finally, the operator send a finish signal at each sync-edge
+        out_control_edges = [(u, v, eattr) for u, v, eattr in op_graph.out_edges(node, data=True) \
+                                                if eattr["edge_type"] == "control" and node2pe(u) != node2pe(v)]
+        for u, v, eattr in out_control_edges:
+            assert len(eattr["pkt"]) == 1
+            instruction_list[-1].append("{} {:.0f} {}".format(pf["send"], eattr["pkt"][0], node2pe(v)))
+
+        return instruction_list
+
+    def __get_streaming_pairs(self, op_graph: nx.DiGraph, serial_graph: nx.DiGraph, order: list) -> dict:
+        r'''Map every sink to the input source it streams data to on the same PE, if that input source \
+            can be issued right after the sink, i.e. all its other predecessors come before the sink in `order`.
+        '''
+        position = {node: i for i, node in enumerate(order)}
+        ret, paired = {}, set()
+        for node in order:
+            if op_graph.nodes[node]["op_type"] != "sink":
+                continue
+            for succ in serial_graph.successors(node):
+                if succ in paired or op_graph.nodes[succ]["op_type"] != "insrc" \
+                        or op_graph.edges.get((node, succ), {}).get("edge_type") != "data":
+                    continue
+                if all(position[p] < position[node] for p in serial_graph.predecessors(succ) if p != node):
+                    ret[node] = succ
+                    paired.add(succ)
+                    break
+        return ret
+
+    def __interleave(self, producer: list, consumer: list) -> list:
+        r'''Merge the iterations of a producer and of a consumer on the same PE, every producer iteration \
+            (tile j) placed right before the consumer iteration j * len(consumer) // len(producer) that \
+            first uses it, as in `__observe_dependent_data`.
+        '''
+        ret, j = [], 0
+        for i, it in enumerate(consumer):
+            while j < len(producer) and j * len(consumer) // len(producer) <= i:
+                ret.append(producer[j])
+                j += 1
+            ret.append(it)
+        return ret + producer[j:]
 
     def __get_pkt_endpoints(self, op_graph: nx.DiGraph, edge_type: str) -> dict:
         # {pid: {"src": src, "dst": [d1, d2], "size": size}}
@@ -348,17 +475,11 @@ class TraceGenerator:
         if op_iters == 0 or dep_num == 0:
             assert False
 
-        # One must be exactly divided by the other
-        assert op_iters % dep_num == 0 or dep_num % op_iters == 0
-        if dep_num <= op_iters:
-            iter_interval = op_iters // dep_num
-            for i in range(0, op_iters, iter_interval):
-                instruction_list[i].append("{} {}".format(instr_prefix, dependent_data[i // iter_interval]))
-        else:
-            tensors_per_iter = dep_num // op_iters
-            for i in range(0, op_iters):
-                for j in range(tensors_per_iter):
-                    instruction_list[i].append("{} {}".format(instr_prefix, dependent_data[i * tensors_per_iter + j]))
+        # The j-th tensor is received by the iteration it falls in when both are spread evenly, which
+        # reduces to one tensor every op_iters / dep_num iterations, or dep_num / op_iters tensors per
+        # iteration, when one divides the other. Counts need not divide, e.g. for streamed tiles.
+        for j, pkt in enumerate(dependent_data):
+            instruction_list[j * op_iters // dep_num].append("{} {}".format(instr_prefix, pkt))
 
     def __observe_sync_signal(self, sync_signals: list, instruction_list: list, instr_prefix):
         for s in sync_signals:
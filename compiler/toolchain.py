@@ -1,10 +1,13 @@
 import os
 import re
+import multiprocessing as mp
 from copy import deepcopy
 import networkx as nx
 from compiler import global_control as gc
 
 from op_graph.micro_op_graph import MicroOpGraph
+from op_graph import graph_cache
+from op_graph import pipeline_analysis
 # Fake trace generator
 from fake_trace_generator.generator import gen_fake_trace
 # Timeloop agents
@@ -13,11 +16,18 @@ from timeloop_agents.layer import TimeloopLayer
 from mapping_algorithms.random_mapper import RandomMapper
 from mapping_algorithms.hilbert_mapper import HilbertMapper
 # Tree Generator
-from compiler.routing_algorithms.meshtree_router import MeshTreeRouter
+from compiler.routing_algorithms.meshtree_router import multicast_routers
+from compiler.routing_algorithms.tree_cache import CachedRouter
 # The backend to generate trace for spatial_sim
 from compiler.spatialsim_agents.trace_generator import TraceGenerator
 from compiler.spatialsim_agents.variables import Variables
 
+
+def _draw(op_graph, visualization_root):
+    op_graph.draw_graph(os.path.join(visualization_root, "micro_operators.png"))
+    op_graph.draw_mapping(os.path.join(visualization_root, "mapping.png"))
+
+
 class TaskCompiler():
     r'''This module compiles tasks for FOCUS-like spatial architectures. \
     A task is a set of NN layers, indentified with its model name and its serial number, e.g. bert_layer1. \
@@ -34,6 +44,7 @@ class TaskCompiler():
     # traffic = pd.DataFrame(columns=["layer", "src", "dst", "interval", "flit", "counts"])
 
     def __init__(self):
+        self.visualizer = None
         self.layer_names = gc.layer_names
         self.cores = gc.cores
         self.model_names = [re.search(r"(^.+)_", layer).group(1) for layer in gc.layer_names]
@@ -53,15 +64,30 @@ class TaskCompiler():
         # map tasks to pe array
         op_graph = self._map_operators(op_graph)
 
-        nx.write_gpickle(op_graph, "test.gpickle")
+        # Keep the mapped graph with the task, for the tools working on compiled tasks
+        op_graph.save(gc.get_op_graph_path())
 
-        op_graph.draw_graph(os.path.join(gc.visualization_root, "micro_operators.png"))
-        op_graph.draw_mapping(os.path.join(gc.visualization_root, "mapping.png"))
         self.compute_cycles = op_graph.compute_cycles()
+        if gc.pipeline_report:
+            report = pipeline_analysis.dump_report(op_graph, gc.get_pipeline_report_path())
+            print("Info: pipeline bounded by {}, report written to {}".format(report["bottleneck_layer"], gc.get_pipeline_report_path()))
 
         # dump as spatialsim trace
         self._to_spatialsim_trace(op_graph)
 
+        if gc.visualize:
+            # Drawn aside, off the compile path; the driver joins it with `wait_visualization`
+            self.visualizer = mp.Process(target=_draw, args=(op_graph, gc.visualization_root))
+            self.visualizer.start()
+
+    def wait_visualization(self):
+        if self.visualizer is None:
+            return
+        self.visualizer.join()
+        exitcode, self.visualizer = self.visualizer.exitcode, None
+        if exitcode != 0:
+            raise Exception("visualization failed with exit code {}!".format(exitcode))
+
     def get_compute_cycle(self):
         assert hasattr(self, "compute_cycles")
         return self.compute_cycles
@@ -69,17 +95,17 @@ class TaskCompiler():
     def _gen_op_graph(self):
         print("Generating the operator graph using timeloop")
 
-        op_graph = MicroOpGraph()
+        reports = []
         for layer, model, prob_spec, core in zip(self.layer_names, self.model_names, self.prob_spec_names, self.cores):
             print("Info:", "Working for", layer)
             # Initialize the agent
             tlagent = TimeloopLayer(prob_spec, model_dir=model, dram_spatial_size=core, prj_root=gc.prj_root)
             # Invoke timeloop for dataflow reports
-            timeloop_report = tlagent.run(TimeloopLayer.report_as_dataframe)
-            op_graph.add_layer(timeloop_report, gc.batch)
+            reports.append(tlagent.run(TimeloopLayer.report_as_dataframe))
             print("====================== FINISH =========================\n\n")
 
-        return op_graph
+        # The graph only depends on the reports, and is reused across compiles of the same layers
+        return graph_cache.build(reports, gc.batch)
 
 
     def _map_operators(self, op_graph):
@@ -102,9 +128,13 @@ class TaskCompiler():
         specification_ref_file = open(Variables.get_ref_spec_path(gc.spatial_sim_root), "r")
 
         # Generate multicast tree for multi-end packets
-        router = MeshTreeRouter(gc.array_diameter)
+        router = multicast_routers[gc.multicast_router](gc.array_diameter)
+        if gc.tree_cache:
+            router = CachedRouter(router)
         TraceGenerator().gen_trace(trace_files, routing_board_file, specification_file, \
             specification_ref_file, op_graph, router)
+        if gc.tree_cache:
+            router.report()
 
         for f in trace_files.values():
             f.close()
@@ -0,0 +1,49 @@
+import os
+import json
+import shutil
+import tempfile
+import numpy as np
+
+
+meta_file = "meta.json"
+
+
+def save_columns(dest_dir: str, columns: dict, meta: dict):
+    r'''Store `columns` (name -> numpy array) as one .npy file per column under `dest_dir`, \
+        together with a json file of `meta`. \
+        The directory is written aside and swapped in, so concurrent readers never see a half-written store.
+    '''
+    parent = os.path.dirname(os.path.abspath(dest_dir))
+    if not os.path.exists(parent):
+        os.makedirs(parent)
+
+    tmp_dir = tempfile.mkdtemp(dir=parent, prefix=".tmp_")
+    for name, array in columns.items():
+        np.save(os.path.join(tmp_dir, name + ".npy"), np.ascontiguousarray(array), allow_pickle=False)
+    with open(os.path.join(tmp_dir, meta_file), "w") as f:
+        json.dump(meta, f)
+
+    if os.path.exists(dest_dir):
+        trash = tempfile.mkdtemp(dir=parent, prefix=".old_")
+        os.replace(dest_dir, os.path.join(trash, "store"))
+        shutil.rmtree(trash, ignore_errors=True)
+    try:
+        os.replace(tmp_dir, dest_dir)
+    except OSError:
+        # Another process has just published the same store
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def load_meta(src_dir: str):
+    path = os.path.join(src_dir, meta_file)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def load_columns(src_dir: str, names: list, mmap=True) -> dict:
+    r'''Load the named columns from `src_dir`, memory-mapped read-only if `mmap` is set.
+    '''
+    mode = "r" if mmap else None
+    return {name: np.load(os.path.join(src_dir, name + ".npy"), mmap_mode=mode, allow_pickle=False) for name in names}
@@ -137,11 +137,15 @@ def run_single_task():
     #     # for debugging
     #     if gc.scheduler_verbose:
     #         ea_controller = EA.EvolutionController(population_size=gc.population_size, n_evolution=gc.n_evolution, 
-    #                                             log_path=os.path.join(gc.focus_buffer, gc.taskname, "ea_output"))
+    #                                             log_path=os.path.join(gc.focus_buffer, gc.taskname, "ea_output"),
+    #                                             crossover_operators=gc.crossover_operators)
+    #     elif gc.batch_evaluate:
+    #         ea_controller = EA.BatchEvolutionController(population_size=gc.population_size, n_evolution=gc.n_evolution,
+    #             log_path=gc.get_ea_logpath(), crossover_operators=gc.crossover_operators)
     #     else:
     #         ea_controller = EA.ParallelEvolutionController(n_workers=gc.n_workers,
     #             population_size=gc.population_size, n_evolution=gc.n_evolution,
-    #             log_path=gc.get_ea_logpath())
+    #             log_path=gc.get_ea_logpath(), crossover_operators=gc.crossover_operators)
 
     #         ea_controller.init_population(individual.individual_generator)
     #         best_individual, _ = ea_controller.run_evolution_search(gc.scheduler_verbose)
@@ -155,6 +159,9 @@ def run_single_task():
     end_time = time()
     print("METRO software takes: {} seconds".format(end_time - start_time))
 
+    if gc.compile_task:
+        toolchain.wait_visualization()
+
 
 if __name__ == "__main__":
     parser = getArgumentParser()
@@ -0,0 +1,156 @@
+'''Compare the multicast routers of `compiler/routing_algorithms` on the same (src, dests) sets.
+
+Two kinds of request sets are generated for every array diameter:
+  - random: seeded uniform sources and destination sets, with a share of broadcast-heavy requests;
+  - workload: the multicast flows of the focus traces under `buffer/focus`, whose mapped PEs
+    (`map_src`, `map_dst`) are rescaled from the array they were mapped on to the benchmarked one.
+
+For each router it reports the routing time, the number of mesh links the trees occupy, the
+largest root-to-leaf hop count, and the per-link load of all trees routed together (each flow
+weighted by flit / interval; tree edges spanning several hops are walked X first, then Y).
+
+Usage (from the project root):
+    PYTHONPATH=. python scripts/router_benchmark.py -d 4 8 16 32 64 -o results/router_benchmark.csv
+'''
+import os
+import sys
+import glob
+import time
+import random
+import argparse
+import numpy as np
+import pandas as pd
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root)
+
+from compiler import global_control as gc
+from compiler.routing_algorithms import meshtree_router
+from compiler.focus import trace_store
+
+
+routers = dict(meshtree_router.multicast_routers)
+routers["hamiltonian_multi"] = lambda diameter: meshtree_router.HamiltonianPathRouter(diameter, n_paths=4)
+
+
+def random_requests(diameter: int, n_requests: int, seed: int) -> list:
+    '''Seeded (src, dests, weight) requests: 3/4 small groups, 1/4 broadcasts to up to half of the array.
+    '''
+    rnd = random.Random(seed)
+    n_pe = diameter * diameter
+    ret = []
+    for i in range(n_requests):
+        src = rnd.randrange(n_pe)
+        max_dests = max(2, n_pe // 2) if i % 4 == 3 else min(16, n_pe - 1)
+        n_dests = rnd.randint(2, min(max_dests, n_pe - 1))
+        dests = rnd.sample([pe for pe in range(n_pe) if pe != src], n_dests)
+        ret.append((src, dests, 1.0))
+    return ret
+
+
+def workload_requests(diameter: int, trace_dir: str) -> list:
+    '''The multicast flows of every focus trace, rescaled to a `diameter` x `diameter` array.
+    '''
+    ret = []
+    for task_dir in sorted(glob.glob(os.path.join(trace_dir, "*"))):
+        traces = sorted(glob.glob(os.path.join(task_dir, "trace_*.json")))
+        if not traces:
+            continue
+        trace = trace_store.load_trace(traces[0])
+        trace = trace[trace["map_dst"].map(len) > 1]
+        if trace.empty:
+            continue
+
+        max_pe = max(trace["map_src"].map(max).max(), trace["map_dst"].map(max).max())
+        src_diameter = int(np.ceil(np.sqrt(max_pe + 1)))
+        rescale = lambda pe: (pe // src_diameter) * diameter // src_diameter * diameter \
+            + (pe % src_diameter) * diameter // src_diameter
+
+        for _, row in trace.iterrows():
+            src = rescale(row["map_src"][0])
+            dests = sorted({rescale(pe) for pe in row["map_dst"]} - {src})
+            if dests:
+                ret.append((src, dests, row["flit"] / row["interval"]))
+    return ret
+
+
+def link_load(trees: list, weights: list, diameter: int) -> np.ndarray:
+    '''Accumulated weight on every directed mesh link, indexed by `src_pe * 4 + direction` (N, S, W, E).
+    '''
+    load = np.zeros(diameter * diameter * 4)
+    for tree, weight in zip(trees, weights):
+        for u, v in tree.edges():
+            ux, uy, vx, vy = u // diameter, u % diameter, v // diameter, v % diameter
+            # X (column index) first, then Y (row index)
+            while uy != vy:
+                step = 1 if vy > uy else -1
+                load[(ux * diameter + uy) * 4 + (3 if step > 0 else 2)] += weight
+                uy += step
+            while ux != vx:
+                step = 1 if vx > ux else -1
+                load[(ux * diameter + uy) * 4 + (1 if step > 0 else 0)] += weight
+                ux += step
+    return load
+
+
+def benchmark(router_name: str, diameter: int, requests: list, seed: int) -> dict:
+    random.seed(seed)
+    router = routers[router_name](diameter)
+
+    trees = []
+    begin = time.perf_counter()
+    router.plan(requests)
+    for src, dests, _ in requests:
+        trees.append(router.route(src, list(dests)))
+    elapsed = time.perf_counter() - begin
+
+    load = link_load(trees, [w for _, _, w in requests], diameter)
+    return {
+        "router": router_name,
+        "time_ms": elapsed * 1e3,
+        "time_per_tree_us": elapsed * 1e6 / len(requests),
+        "links": sum(tree.link_count() for tree in trees),
+        "max_depth": max(tree.depth() for tree in trees),
+        "mean_depth": np.mean([tree.depth() for tree in trees]),
+        "max_link_load": load.max(),
+        "mean_link_load": load[load > 0].mean(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the multicast routers.")
+    parser.add_argument("-d", "--diameters", type=int, nargs="+", default=[4, 8, 16, 32, 64])
+    parser.add_argument("-r", "--routers", nargs="+", default=list(routers.keys()), choices=list(routers.keys()))
+    parser.add_argument("-n", "--n_requests", type=int, default=200, help="random requests per diameter")
+    parser.add_argument("-s", "--seed", type=int, default=0)
+    parser.add_argument("--max_steiner_diameter", type=int, default=16,
+                        help="skip the reference Steiner router (quadratic in the tree size) on larger arrays")
+    parser.add_argument("-o", "--output", default=os.path.join(gc.result_root, "router_benchmark.csv"))
+    args = parser.parse_args()
+
+    rows = []
+    for diameter in args.diameters:
+        request_sets = {
+            "random": random_requests(diameter, args.n_requests, args.seed),
+            "workload": workload_requests(diameter, gc.focus_buffer),
+        }
+        for set_name, requests in request_sets.items():
+            if not requests:
+                continue
+            for router_name in args.routers:
+                if router_name == "steiner" and diameter > args.max_steiner_diameter:
+                    continue
+                row = {"diameter": diameter, "set": set_name, "n_requests": len(requests)}
+                row.update(benchmark(router_name, diameter, requests, args.seed))
+                rows.append(row)
+                print("d={:<3} {:<9} {:<17} {:>10.1f} ms  links={:<8} depth={:<4} max_load={:.3f}".format(
+                    diameter, set_name, router_name, row["time_ms"], row["links"], row["max_depth"], row["max_link_load"]))
+
+    result = pd.DataFrame(rows)
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    result.to_csv(args.output, index=False, float_format="%.4f")
+    print("\nResults written to {}".format(args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 import os
 import pandas as pd
 from compiler import global_control as gc
+from compiler.focus import trace_store
 
 def link_length(node_list):
     d = gc.array_diameter
@@ -11,7 +12,7 @@ def link_length(node_list):
 
 
 os.chdir("..")
-best_trace = pd.read_json("best_scheduling.json")
+best_trace = trace_store.load_trace("best_scheduling.json")
 best_trace["captain"] = best_trace["captain"].map(lambda x: [x] if not pd.isna(x) else x)
 best_trace.loc[best_trace["captain"].isna(), "captain"] = best_trace[best_trace["captain"].isna()]["src"]
 